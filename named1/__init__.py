@@ -1,9 +1,15 @@
 __version__ = "0.2.1"
 
+# Upstream DNS-over-HTTPS servers. The format is either "dns-message" (RFC 8484
+# wire format) or "dns-json" (the JSON API, default). With "transport": "dot",
+# DNS over TLS (RFC 7858) is used instead, on port 853 and without path/format.
+# Optional "port" and "cafile" allow pointing at local servers, such as the
+# benchmark stand-in.
 providers = {
     "cloudflare": {
         "host": "cloudflare-dns.com",
         "path": "/dns-query",
+        "format": "dns-message",
         "ipv4": ["1.0.0.1", "1.1.1.1"],
         "ipv6": ["2606:4700:4700::1111", "2606:4700:4700::1001"],
     },
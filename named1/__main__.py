@@ -1,62 +1,130 @@
+import os
+import signal
+import sys
 from collections import defaultdict
+from contextlib import suppress
 
 import trio
 
-from named1 import __version__, providers, ramcache
+from named1 import (
+    __version__,
+    hedging,
+    metrics,
+    policy,
+    prefetch,
+    providers,
+    ramcache,
+    ratelimit,
+    trace,
+)
 from named1.dnserror import WontResolve
 from named1.nameclient import NameClient
 from named1.serve53 import serve53
+from named1.sharedcache import SharedCache
 
+ingest_queue = 1024  # Answers waiting to be cached, beyond which they are dropped
+ingest_batch = 256  # Answers cached at a time
+ingest = None  # Sender to ingest_task
+stats_ingested = stats_duplicates = stats_late = stats_ingest_dropped = 0
 
-async def cacher_task(receiver):
-    with trio.move_on_after(10):
-        async with receiver:
-            async for res in receiver:
-                await ramcache.cache(res)
+
+def cache_answer(res, answered):
+    """Queue the first upstream answer to a query for caching, answers from
+    slower providers arriving later are dropped."""
+    global stats_late, stats_ingest_dropped
+    if res.get("Status") not in (0, 3):
+        return
+    if answered:
+        stats_late += 1
         return
+    answered.append(res)
+    try:
+        ingest.send_nowait(res)
+    except trio.WouldBlock:
+        stats_ingest_dropped += 1
+
+
+async def ingest_task(receiver):
+    """Cache answers in batches, keeping only the latest for each question."""
+    global stats_ingested, stats_duplicates
+    async for res in receiver:
+        batch = {}
+        while True:
+            q = res["Question"][0]
+            key = q["name"].lower(), q["type"]
+            stats_duplicates += key in batch
+            batch[key] = res
+            if len(batch) >= ingest_batch:
+                break
+            try:
+                res = receiver.receive_nowait()
+            except trio.WouldBlock:
+                break
+        ramcache.cache(batch.values())
+        stats_ingested += len(batch)
 
 
-async def resolve_task(sender, resolver, dnsquery, done, success):
+async def resolve_task(sender, resolver, dnsquery, done, success, answered):
     async with sender:
         stats_queries[resolver.name] += 1
         start_time = trio.current_time()
         try:
             # This can be longer running than interactive requests
-            with trio.move_on_after(5):
-                sender.send_nowait(await resolver.resolve(**dnsquery))
+            with trio.move_on_after(5) as timeout:
+                res = await resolver.resolve(**dnsquery)
+                if resolver.name != "RamCache":
+                    cache_answer(res, answered)
+                with suppress(trio.BrokenResourceError):  # Late, query answered
+                    sender.send_nowait(res)
                 success()
                 stats_count[resolver.name] += 1
-                duration = min(1.0, trio.current_time() - start_time)
-                stats_time[resolver.name] = (
-                    0.9 * (stats_time[resolver.name] or duration) + 0.1 * duration
-                )
-            return
-        except trio.BrokenResourceError:  # We are late, receiver is dead
-            pass
+                duration = trio.current_time() - start_time
+                metrics.histogram(
+                    "named1_resolver_seconds", resolver=resolver.name
+                ).observe(duration)
+                hedging.latency(resolver.name).observe(duration)
+            if not timeout.cancelled_caught:
+                return
         except WontResolve:  # Resolver can't handle it
-            return
+            if resolver.name == "RamCache":
+                return  # Not cached
         finally:
             done.set()  # Signal that we are no longer working
-    stats_time[resolver.name] = 0.0
+    # Failures rank a provider as slow, however quickly they were reported
+    duration = trio.current_time() - start_time
+    hedging.latency(resolver.name).observe(max(duration, hedging.max_delay))
     stats_timeouts[resolver.name] += 1
 
 
 async def resolve_happy(resolvers, dnsquery, nursery, sender):
     async with sender, trio.open_nursery() as happy_eyeballs:
         success = happy_eyeballs.cancel_scope.cancel
+        upstream = None  # Done event of the latest upstream request
+        answered = []  # Upstream answer being cached
         for r in resolvers:
-            done = trio.Event()
-            nursery.start_soon(resolve_task, sender.clone(), r, dnsquery, done, success)
-            with trio.move_on_after(0.005 if r.name == "RamCache" else 0.1):
+            if r.name != "RamCache":
+                if upstream is None:
+                    hedging.earn()
+                elif not upstream.is_set() and not hedging.allow():
+                    await upstream.wait()  # Out of hedging budget, only fail over
+                upstream = done = trio.Event()
+            else:
+                done = trio.Event()
+            nursery.start_soon(
+                resolve_task, sender.clone(), r, dnsquery, done, success, answered
+            )
+            # Hedge with the next resolver once most requests would have finished
+            with trio.move_on_after(hedging.delay(hedging.latency(r.name))):
                 await done.wait()
 
 
+stale_after = 0.5  # Seconds to wait for upstream before serving stale answers
+
 stat_res = None
-stats_requests = 0
+stats_requests = stats_coalesced = 0
 stats_names = []
 stats_fastest = defaultdict(int)
 stats_count = defaultdict(int)
-stats_time = defaultdict(float)
 stats_queries = defaultdict(int)
 stats_timeouts = defaultdict(int)
 
@@ -77,35 +145,103 @@ async def stats_task():
             except:
                 req = str(stat_res["name"])
             ret += f"\033[32m[{client}] {req[:50]}\033[K"
-        ret += (
-            "\033[0m\n\nProvider       Resolved    Fastest / %   Avg.  Queries Timeouts"
-        )
+        ret += f"\033[0m\nCached: {len(ramcache.cache_store)} entries, "
+        ret += f"{ramcache.stats_evictions} evicted, {ramcache.stats_stale} stale  "
+        ret += f"Coalesced: {stats_coalesced}  "
+        ret += f"Prefetched: {prefetch.stats_prefetches}, "
+        ret += f"{prefetch.stats_prefetch_hits} hit, {prefetch.stats_prefetch_waste} wasted"
+        ret += f"  Blocked: {policy.stats_blocked}  Hosts: {policy.stats_overridden}"
+        ret += f"  Hedged: {hedging.stats_hedges}, {hedging.stats_hedges_denied} denied"
+        ret += f"  Limited: {ratelimit.stats_slipped} slipped, {ratelimit.stats_dropped} dropped, {ratelimit.stats_miss_limited} misses"
+        ret += "\033[K\nProvider       Resolved    Fastest / %    p50    p90  Queries Timeouts"
         for k in stats_names:
             c = stats_count[k]
-            t = f"{1000 * stats_time[k]:4.0f}ms" if stats_time[k] else "   -  "
+            t = " ".join(
+                f"{1000 * v:4.0f}ms" if v is not None else "   -  "
+                for v in map(hedging.latency(k).percentile, (50, 90))
+            )
             p = f"{stats_fastest[k] / queries:5.0%}" if queries else "   - "
             ret += f"\n\033[0;32m{k:15}  \033[1m{c:6d}   {stats_fastest[k]:6d} {p} {t} {stats_queries[k]:8d} {stats_timeouts[k]:8d}\033[K"
         print(ret, end="\033[K\033[0m\0338", flush=True)
         await trio.sleep(0.1)
 
 
-async def amain(debug: bool):
-    async def resolve(**dnsquery):
+async def sigterm_task(cancel_scope):
+    # Ignored after the receiver exits, so that saving the cache can finish
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    with trio.open_signal_receiver(signal.SIGTERM) as signals:
+        async for _ in signals:
+            cancel_scope.cancel()  # Exit cleanly so that the cache gets saved
+
+
+cache_loaded = False  # Saving before would replace the snapshot with part of it
+
+
+async def load_task(cache_file, snapshots):
+    global cache_loaded
+    loaded = await ramcache.load(cache_file)
+    cache_loaded = True
+    print(f"[RamCache] {loaded} entries loaded from {cache_file}")
+    if snapshots:
+        await ramcache.snapshot_task(cache_file)
+
+
+def collect_metrics():
+    ret = [
+        ("named1_requests_total", {}, stats_requests),
+        ("named1_coalesced_total", {}, stats_coalesced),
+        ("named1_cache_ingested_total", {}, stats_ingested),
+        ("named1_cache_ingest_duplicates_total", {}, stats_duplicates),
+        ("named1_cache_ingest_dropped_total", {}, stats_ingest_dropped),
+        ("named1_late_answers_total", {}, stats_late),
+        ("named1_cache_ingest_queue", {}, ingest.statistics().current_buffer_used),
+    ]
+    for k in stats_names:
+        labels = dict(resolver=k)
+        ret += [
+            ("named1_resolver_queries_total", labels, stats_queries[k]),
+            ("named1_resolver_answers_total", labels, stats_count[k]),
+            ("named1_resolver_fastest_total", labels, stats_fastest[k]),
+            ("named1_resolver_timeouts_total", labels, stats_timeouts[k]),
+        ]
+    return ret
+
+
+async def amain(
+    debug: bool, cache_file=None, snapshots=True, metrics_port=None, port=53
+):
+    global ingest
+
+    async def resolve(cached=True, upstream=True, **dnsquery):
         global stats_requests, stats_names, stat_res
         nonlocal nursery
         stats_requests += 1
         stat_res = dnsquery
+        local = policy.resolve(**dnsquery)
+        if local:
+            stat_res = local
+            return local
+        if not upstream:  # Client over its rate limit, answer only from cache
+            try:
+                fastest = await ramcache.resolve(**dnsquery)
+            except WontResolve:
+                fastest = await ramcache.resolve(stale=True, **dnsquery)
+            stats_fastest[fastest["NameClient"]] += 1
+            return fastest
         resolvers = [
             ramcache,
-            *sorted(nclients, key=lambda nc: stats_time[nc.name] or 1),
+            *sorted(
+                nclients,
+                key=lambda nc: (
+                    hedging.latency(nc.name).average or hedging.default_delay
+                ),
+            ),
         ]
         stats_names = [r.name for r in resolvers]
-        # RamCache and Cloudflare cannot answer type ANY requests
+        # RamCache cannot answer type ANY requests
         type_any = dnsquery["type"] == 255
-        if type_any:
-            resolvers = [
-                r for r in resolvers if r.name not in ("RamCache", "cloudflare")
-            ]
+        if type_any or not cached:
+            resolvers = resolvers[1:]
         sender, receiver = trio.open_memory_channel(len(nclients))
         async with sender, receiver:
             # Staggered startups of resolving tasks on each suitable provider
@@ -114,18 +250,66 @@ async def amain(debug: bool):
             )
             fastest = None
             # Timeout for answering downstream requests
-            with trio.move_on_after(5 if type_any else 0.95):
+            deadline = trio.current_time() + (5 if type_any else 0.95)
+            with trio.move_on_after(stale_after):
                 fastest = await receiver.receive()
-                sender.send_nowait(fastest)  # Put the fastest back for cacher
-            # Cache any received answers
-            nursery.start_soon(cacher_task, receiver.clone())
+            if not fastest and cached and not type_any:
+                # Upstream is slow, answer from expired cache and keep resolving
+                try:
+                    fastest = await ramcache.resolve(stale=True, **dnsquery)
+                except WontResolve:
+                    pass
+            if not fastest:
+                with trio.move_on_at(deadline):
+                    fastest = await receiver.receive()
         if fastest:
             statkey = fastest["NameClient"]
             stat_res = fastest
             stats_fastest[statkey] += 1
+            if statkey == "RamCache" and not fastest.get("Stale"):
+                prefetch.hit(dnsquery["name"], dnsquery["type"], fastest)
             return fastest
         raise trio.TooSlowError
 
+    async def resolve_coalesced(**dnsquery):
+        """Identical concurrent queries share the result of the first one."""
+        global stats_coalesced
+        key = (
+            str(dnsquery["name"]).lower(),
+            dnsquery["type"],
+            dnsquery.get("do"),
+            dnsquery.get("upstream", True),
+        )
+        flight = inflight.get(key)
+        if flight:
+            stats_coalesced += 1
+            done, result = flight
+            await done.wait()
+            if result:
+                return result[0]
+            raise trio.TooSlowError
+        inflight[key] = done, result = trio.Event(), []
+        try:
+            result.append(await resolve(**dnsquery))
+            return result[0]
+        finally:
+            del inflight[key]
+            done.set()
+
+    async def resolve_traced(**dnsquery):
+        start, res = trio.current_time(), None
+        try:
+            res = await resolve_coalesced(**dnsquery)
+            return res
+        finally:
+            trace.record(dnsquery, res, trio.current_time() - start)
+
+    async def refresh(name, type):
+        return await resolve(name=name, type=type, do="0", cached=False)
+
+    inflight = {}  # (name, type, do) -> (done event, [result])
+    ingest, ingested = trio.open_memory_channel(ingest_queue)
+
     # Main program runs servers and client connections
     if debug:
         print("\033[?1049h\033[10r\033[10H", end="")
@@ -133,14 +317,28 @@ async def amain(debug: bool):
     else:
         print(f"Named1 {__version__} starting in normal mode (python -d for debug)")
     nclients = [NameClient(name, servers) for name, servers in providers.items()]
+    metrics.collectors.append(collect_metrics)
+    metrics.collectors += [nclient.collect_metrics for nclient in nclients]
     try:
         async with trio.open_nursery() as nursery:
             if debug:
                 nursery.start_soon(stats_task)
-            await nursery.start(serve53, ("0.0.0.0", 53), resolve)
-            await nursery.start(serve53, ("::", 53), resolve)
+            if metrics_port:
+                await nursery.start(metrics.serve_metrics, metrics_port)
+            serve = resolve_traced if trace.path else resolve_coalesced
+            if trace.path:
+                nursery.start_soon(trace.trace_task)
+            await nursery.start(serve53, ("0.0.0.0", port), serve)
+            await nursery.start(serve53, ("::", port), serve)
+            nursery.start_soon(ingest_task, ingested)
             for nclient in nclients:
                 nursery.start_soon(nclient.execute)
+            nursery.start_soon(prefetch.prefetch_task, refresh)
+            if policy.blocklists or policy.hosts_files:
+                nursery.start_soon(policy.policy_task)
+            if cache_file:
+                nursery.start_soon(load_task, cache_file, snapshots)
+                nursery.start_soon(sigterm_task, nursery.cancel_scope)
     except KeyboardInterrupt:
         if debug:
             raise  # Traceback plz!
@@ -150,13 +348,128 @@ async def amain(debug: bool):
         print("Exiting Named1")
 
 
+def run(debug, cache_file, snapshots=True, metrics_port=None, port=53):
+    try:
+        trio.run(amain, debug, cache_file, snapshots, metrics_port, port)
+    finally:
+        if cache_file and snapshots and not cache_loaded:
+            print(f"[RamCache] not saved, {cache_file} was still being loaded")
+        elif cache_file and snapshots:
+            trio.run(ramcache.save, cache_file)
+            print(f"[RamCache] saved to {cache_file}")
+
+
 def main():
     import argparse
 
     parser = argparse.ArgumentParser(description="Named1 DNS server")
     parser.add_argument("-d", "--debug", action="store_true", help="Enable debug mode")
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=ramcache.max_entries,
+        help="Maximum number of names and types cached in RAM",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes, sharing the port and the cache",
+    )
+    parser.add_argument(
+        "--port", type=int, default=53, help="DNS port to listen on (UDP and TCP)"
+    )
+    parser.add_argument(
+        "--blocklist",
+        action="append",
+        default=[],
+        metavar="FILE",
+        help="Block the domains listed and their subdomains (reloaded on changes)",
+    )
+    parser.add_argument(
+        "--block-mode",
+        choices=["nxdomain", "null"],
+        default=policy.block_mode,
+        help="Answer blocked names with NXDOMAIN or 0.0.0.0 and ::",
+    )
+    parser.add_argument(
+        "--hosts",
+        action="append",
+        default=[],
+        metavar="FILE",
+        help="Answer names in this hosts file locally (reloaded on changes)",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=ratelimit.responses_per_second,
+        help="UDP responses per second to each client /24 or /56 network (default off)",
+    )
+    parser.add_argument(
+        "--miss-limit",
+        type=float,
+        default=ratelimit.misses_per_second,
+        help="Queries per second sent upstream for each client network (default off)",
+    )
+    parser.add_argument(
+        "--cache-file",
+        help="Save the cache to this file periodically and load it on startup",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="Append a binary log of queries to this file (one per worker), "
+        "for replaying with python -m named1.replay",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=int,
+        metavar="PORT",
+        help="Serve metrics on localhost (Prometheus /metrics, JSON /json), "
+        "using consecutive ports for workers",
+    )
     args = parser.parse_args()
-    trio.run(amain, args.debug)
+    ramcache.max_entries = args.cache_size
+    trace.path = args.trace
+    policy.blocklists = args.blocklist
+    policy.hosts_files = args.hosts
+    policy.block_mode = args.block_mode
+    ratelimit.responses_per_second = args.rate_limit
+    ratelimit.misses_per_second = args.miss_limit
+    ratelimit.response_burst = max(1, 2 * args.rate_limit)
+    ratelimit.miss_burst = max(1, 2 * args.miss_limit)
+    if args.workers > 1:
+        if args.debug:
+            parser.error("debug mode needs a single worker")
+        ramcache.shared = SharedCache()
+    if args.workers == 1:
+        run(args.debug, args.cache_file, metrics_port=args.metrics, port=args.port)
+        return
+    pids = []
+    for worker in range(args.workers):
+        pid = os.fork()
+        if not pid:
+            try:
+                # Only the first worker saves the cache, including shared entries
+                metrics_port = args.metrics and args.metrics + worker
+                trace.path = args.trace and f"{args.trace}.{worker}"
+                run(False, args.cache_file, not worker, metrics_port, args.port)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                sys.stdout.flush()
+                os._exit(0)
+        pids.append(pid)
+    signal.signal(
+        signal.SIGTERM, lambda *_: [os.kill(pid, signal.SIGTERM) for pid in pids]
+    )
+    for pid in pids:
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                break
+            except KeyboardInterrupt:
+                pass  # Workers get it too and exit by themselves
 
 
 if __name__ == "__main__":
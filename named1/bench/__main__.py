@@ -0,0 +1,204 @@
+import json
+import os
+import secrets
+import sys
+import tempfile
+
+import trio
+
+from named1.bench.fakedoh import FakeDoH, make_cert
+from named1.bench.loadgen import load
+
+# Runs named1 with providers replaced by the local stand-ins given in argv[1]
+BOOT = """import json, sys, named1
+named1.providers.clear()
+named1.providers.update(json.loads(sys.argv.pop(1)))
+from named1.__main__ import main
+main()
+"""
+
+scenarios = {}
+
+
+def scenario(f):
+    scenarios[f.__name__.replace("_", "-")] = f
+    return f
+
+
+class Bench:
+    def __init__(self, args, upstreams):
+        self.args = args
+        self.upstreams = upstreams
+        self.server = "127.0.0.1", args.port
+        self.tag = secrets.token_hex(3)  # Unique names on each run
+
+    def names(self, prefix, count):
+        return [f"{prefix}{i}.{self.tag}.bench" for i in range(count)]
+
+    async def ready(self):
+        with trio.fail_after(10):
+            while not (await load(self.server, ["ready.bench"], count=1))["answered"]:
+                await trio.sleep(0.1)
+
+    def reset(self):
+        for u in self.upstreams:
+            u.latency, u.jitter, u.error_rate, u.goaway_after = 0.02, 0.01, 0.0, 0
+
+    async def run(self, name):
+        self.reset()
+        requests = sum(u.stats_requests for u in self.upstreams)
+        connections = sum(u.stats_connections for u in self.upstreams)
+        res = await scenarios[name](self)
+        res["upstream_requests"] = (
+            sum(u.stats_requests for u in self.upstreams) - requests
+        )
+        res["upstream_connections"] = (
+            sum(u.stats_connections for u in self.upstreams) - connections
+        )
+        return res
+
+
+@scenario
+async def cache_hit(b):
+    """Throughput of answers from cache."""
+    names = b.names("hit", 100)
+    await load(b.server, names, concurrency=10, count=len(names))
+    return await load(b.server, names, concurrency=50, duration=b.args.duration)
+
+
+@scenario
+async def cold_miss(b):
+    """Latency of unique names that always go upstream (20-30 ms)."""
+    names = b.names("cold", b.args.queries)
+    return await load(b.server, names, concurrency=10, count=len(names))
+
+
+@scenario
+async def duplicate_burst(b):
+    """Bursts of 200 identical queries for names not yet cached."""
+    names = [n for n in b.names("burst", b.args.queries // 200) for _ in range(200)]
+    return await load(b.server, names, concurrency=200, count=len(names))
+
+
+@scenario
+async def brownout(b):
+    """One upstream slow (0.5 s) and failing 30 % of requests."""
+    b.upstreams[0].latency, b.upstreams[0].error_rate = 0.5, 0.3
+    names = b.names("brownout", b.args.queries)
+    return await load(b.server, names, concurrency=10, count=len(names))
+
+
+@scenario
+async def churn(b):
+    """Upstreams sending GOAWAY after every 50 requests."""
+    for u in b.upstreams:
+        u.goaway_after = 50
+    names = b.names("churn", b.args.queries)
+    return await load(b.server, names, concurrency=10, count=len(names))
+
+
+def _table(results, baseline):
+    columns = "qps", "p50_ms", "p95_ms", "p99_ms", "lost", "upstream_requests"
+    print(f"{'scenario':16}" + "".join(f"{c:>18}" for c in columns))
+    for name, res in results.items():
+        line = f"{name:16}"
+        for c in columns:
+            cell = f"{res[c]}"
+            old = baseline.get(name, {}).get(c)
+            if old:
+                cell += f" {100 * (res[c] - old) / old:+.0f}%"
+            line += f"{cell:>18}"
+        print(line)
+
+
+async def amain(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = make_cert(tmp)
+        upstreams = [FakeDoH(cert, key), FakeDoH(cert, key)]
+        async with trio.open_nursery() as nursery:
+            providers = {}
+            for i, (u, format, path) in enumerate(
+                zip(
+                    upstreams,
+                    ("dns-message", "dns-json"),
+                    ("/dns-query", "/resolve"),
+                )
+            ):
+                provider = providers[f"fake{i}"] = dict(
+                    host="localhost", ipv4=["127.0.0.1"], ipv6=[], cafile=cert
+                )
+                if args.transport == "dot":
+                    provider.update(
+                        transport="dot", port=await nursery.start(u.serve_dot, 0)
+                    )
+                else:
+                    provider.update(
+                        path=path, format=format, port=await nursery.start(u.serve, 0)
+                    )
+            command = [sys.executable, "-c", BOOT, json.dumps(providers)]
+            command += ["--port", str(args.port), "--workers", str(args.workers)]
+            with open(os.path.join(tmp, "named1.log"), "wb") as log:
+                process = await trio.lowlevel.open_process(
+                    command, stdout=log, stderr=log
+                )
+                try:
+                    b = Bench(args, upstreams)
+                    await b.ready()
+                    results = {}
+                    for name in args.scenarios or scenarios:
+                        results[name] = await b.run(name)
+                        print(f"{name}: {json.dumps(results[name])}", file=sys.stderr)
+                finally:
+                    process.terminate()
+                    await process.wait()
+                    if args.log:
+                        with open(log.name) as f:
+                            sys.stderr.write(f.read())
+            nursery.cancel_scope.cancel()
+    return results
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark named1 against local DoH stand-ins"
+    )
+    parser.add_argument(
+        "scenarios", nargs="*", help=f"Default all: {', '.join(scenarios)}"
+    )
+    parser.add_argument("--port", type=int, default=5353, help="named1 UDP port")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--transport",
+        choices=["https", "dot"],
+        default="https",
+        help="Upstream transport: DNS over HTTPS (one provider JSON, one RFC 8484) "
+        "or DNS over TLS",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=5.0, help="Seconds for throughput runs"
+    )
+    parser.add_argument(
+        "--queries", type=int, default=2000, help="Queries for latency runs"
+    )
+    parser.add_argument("--json", help="Save results to this file")
+    parser.add_argument("--baseline", help="Compare with results saved earlier")
+    parser.add_argument("--log", action="store_true", help="Show named1 output")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in scenarios:
+            parser.error(f"unknown scenario {name}")
+    results = trio.run(amain, args)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    _table(results, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
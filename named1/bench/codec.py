@@ -0,0 +1,75 @@
+"""Microbenchmark of building responses with codec versus dnspython."""
+
+import functools
+import timeit
+
+from dns import edns, message, rrset
+
+from named1 import codec, serve53
+from named1.nameclient import parse_wire
+
+
+def _query(**kwargs):
+    query = message.make_query("www.example.com.", "A", **kwargs)
+    query.id = 4242
+    return query.to_wire()
+
+
+def cases():
+    """(description, query, answer) of typical responses."""
+    question = [dict(name="www.example.com.", type=1)]
+    cached = dict(
+        Status=0,
+        RD=True,
+        RA=True,
+        Question=question,
+        Answer=[
+            dict(name="www.example.com.", type=5, TTL=300, data="a.cdn.example.net."),
+            dict(name="a.cdn.example.net.", type=1, TTL=20, data="192.0.2.1"),
+            dict(name="a.cdn.example.net.", type=1, TTL=20, data="192.0.2.2"),
+        ],
+        Authority=[],
+        NameClient="RamCache",
+    )
+    upstream = message.make_response(message.from_wire(_query(use_edns=0)))
+    upstream.answer.append(
+        rrset.from_text("www.example.com.", 300, "IN", "A", "192.0.2.1", "192.0.2.2")
+    )
+    wire = parse_wire(upstream.to_wire())
+    wire["NameClient"] = "cloudflare"
+    nsid = [edns.GenericOption(edns.NSID, b"")]
+    return [
+        ("cached, no EDNS", _query(), cached),
+        ("cached, EDNS", _query(use_edns=0), cached),
+        ("cached, NSID", _query(use_edns=0, options=nsid), cached),
+        ("upstream wire, EDNS", _query(use_edns=0), wire),
+    ]
+
+
+def fast(data, res):
+    query = codec.parse_query(data)
+    nsid = serve53._nsid(res) if query[5] and query[5][2] else None
+    return codec.response(data, query, res, nsid)
+
+
+def slow(data, res):
+    return serve53._message_response(message.from_wire(data), res)
+
+
+def main():
+    print(f"{'case':24}{'dnspython':>12}{'codec':>12}{'speedup':>10}")
+    for description, data, res in cases():
+        assert message.from_wire(fast(data, res)) == message.from_wire(slow(data, res))
+        times = []
+        for f in slow, fast:
+            call = functools.partial(f, data, res)  # Bound now, not late
+            n = timeit.Timer(call).autorange()[0]
+            times.append(min(timeit.repeat(call, number=n)) / n)
+        print(
+            f"{description:24}{times[0] * 1e6:10.1f}µs{times[1] * 1e6:10.1f}µs"
+            f"{times[0] / times[1]:9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
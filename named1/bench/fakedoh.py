@@ -0,0 +1,248 @@
+import base64
+import hashlib
+import json
+import os
+import random
+import ssl
+import struct
+import subprocess
+from contextlib import suppress
+from urllib.parse import parse_qs, urlsplit
+
+import h2.config
+import h2.connection
+import h2.exceptions
+import trio
+from dns import message, name, rcode, rdatatype, rrset
+from h2.errors import ErrorCodes
+from h2.events import RequestReceived
+
+from named1.nameclient import parse_wire
+
+
+def make_cert(directory):
+    """Self-signed certificate for localhost, returns (certfile, keyfile)."""
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    if not os.path.exists(cert):
+        subprocess.run(
+            [
+                *("openssl", "req", "-x509", "-nodes", "-days", "7", "-subj"),
+                *("/CN=localhost", "-addext", "subjectAltName=DNS:localhost"),
+                *("-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1"),
+                *("-keyout", key, "-out", cert),
+            ],
+            check=True,
+            capture_output=True,
+        )
+    return cert, key
+
+
+def answer(query, ttl):
+    """Deterministic answers: A/AAAA derived from the name, NXDOMAIN for names
+    starting with nx, CNAME for names starting with cname, NODATA for others."""
+    res = message.make_response(query)
+    q = query.question[0]
+    text = q.name.to_text().lower()
+    soa = rrset.from_text(
+        q.name.parent() if len(q.name) > 1 else q.name,
+        ttl,
+        "IN",
+        "SOA",
+        "ns.bench. hostmaster.bench. 1 3600 600 86400 60",
+    )
+    if text.startswith("nx"):
+        res.set_rcode(rcode.NXDOMAIN)
+        res.authority.append(soa)
+        return res
+    target = q.name
+    if text.startswith("cname") and len(q.name) > 2:
+        target = name.from_text("target", origin=q.name.parent())
+        res.answer.append(rrset.from_text(q.name, ttl, "IN", "CNAME", str(target)))
+    h = hashlib.blake2b(target.to_text().lower().encode(), digest_size=16).digest()
+    if q.rdtype == rdatatype.A:
+        data = "10." + ".".join(str(b) for b in h[:3])
+    elif q.rdtype == rdatatype.AAAA:
+        data = "fd00:" + ":".join(h[i : i + 2].hex() for i in range(2, 16, 2))
+    else:
+        res.authority.append(soa)
+        return res
+    res.answer.append(rrset.from_text(target, ttl, "IN", q.rdtype, data))
+    return res
+
+
+class FakeDoH:
+    """Local HTTP/2 DNS-over-HTTPS stand-in for benchmarks. Answers both JSON
+    and RFC 8484 queries, and DNS over TLS with serve_dot. Behaviour attributes
+    may be changed while running."""
+
+    def __init__(self, certfile, keyfile, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = latency  # Seconds added to each response
+        self.jitter = jitter  # Uniformly random seconds added on top of latency
+        self.error_rate = error_rate  # Requests answered HTTP 500 (DoT: SERVFAIL)
+        self.goaway_after = 0  # Close connections after this many requests
+        self.ttl = 300
+        self.stats_requests = self.stats_errors = self.stats_connections = 0
+        self.ssl = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.ssl.load_cert_chain(certfile, keyfile)
+        self.ssl.set_alpn_protocols(["h2"])
+        self.dot_ssl = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.dot_ssl.load_cert_chain(certfile, keyfile)
+        self.dot_ssl.set_alpn_protocols(["dot"])
+
+    def response(self, path):
+        """HTTP status, content-type and body for a request path."""
+        url = urlsplit(path)
+        args = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if "dns" in args:
+            wire = base64.urlsafe_b64decode(args["dns"] + "=" * (-len(args["dns"]) % 4))
+            return (
+                200,
+                "application/dns-message",
+                answer(message.from_wire(wire), self.ttl).to_wire(),
+            )
+        if "name" in args:
+            type = args.get("type", "A")
+            type = int(type) if type.isdigit() else rdatatype.from_text(type)
+            query = message.make_query(args["name"], type)
+            res = parse_wire(answer(query, self.ttl).to_wire())
+            del res["Wire"]
+            return 200, "application/dns-json", json.dumps(res).encode()
+        return 400, "text/plain", b"Missing dns or name parameter"
+
+    async def _request(self, conn, stream_id, headers, send):
+        delay = self.latency + random.random() * self.jitter
+        if delay:
+            await trio.sleep(delay)
+        if random.random() < self.error_rate:
+            self.stats_errors += 1
+            status, ctype, body = 500, "text/plain", b"Simulated failure"
+        else:
+            status, ctype, body = self.response(headers.get(":path", ""))
+        try:
+            conn.send_headers(
+                stream_id,
+                (
+                    (":status", str(status)),
+                    ("content-type", ctype),
+                    ("content-length", str(len(body))),
+                ),
+            )
+            conn.send_data(stream_id, body, end_stream=True)
+        except h2.exceptions.H2Error:
+            return  # Stream reset by client or out of flow control window
+        await send()
+
+    async def _connection(self, stream):
+        self.stats_connections += 1
+        conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False, header_encoding="UTF-8")
+        )
+        conn.initiate_connection()
+        lock = trio.Lock()
+        requests = pending = 0
+        closing = False
+
+        async def send():
+            async with lock:
+                data = conn.data_to_send()
+                if data:
+                    with suppress(trio.BrokenResourceError, trio.ClosedResourceError):
+                        await stream.send_all(data)
+
+        async def request(stream_id, headers):
+            nonlocal pending
+            try:
+                await self._request(conn, stream_id, headers, send)
+            finally:
+                pending -= 1
+            if closing and not pending:
+                # h2 cannot answer streams after sending GOAWAY, so refuse any
+                # new streams and only send it once the running ones are done.
+                conn.close_connection(last_stream_id=conn.highest_inbound_stream_id)
+                await send()
+
+        async with trio.open_nursery() as nursery:
+            await send()
+            while True:
+                try:
+                    data = await stream.receive_some(65536)
+                    events = conn.receive_data(data) if data else None
+                except (trio.BrokenResourceError, h2.exceptions.ProtocolError):
+                    break
+                if not events:
+                    break
+                for event in events:
+                    if not isinstance(event, RequestReceived):
+                        continue
+                    if closing:
+                        conn.reset_stream(event.stream_id, ErrorCodes.REFUSED_STREAM)
+                        continue
+                    requests += 1
+                    pending += 1
+                    self.stats_requests += 1
+                    nursery.start_soon(request, event.stream_id, dict(event.headers))
+                    closing = self.goaway_after and requests >= self.goaway_after
+                await send()
+            nursery.cancel_scope.cancel()
+
+    async def _dot_connection(self, stream):
+        """RFC 7858 pipelined queries, answered in the order they complete.
+        After goaway_after queries, the rest are answered before closing."""
+        self.stats_connections += 1
+        lock = trio.Lock()
+        requests = 0
+
+        async def request(wire):
+            delay = self.latency + random.random() * self.jitter
+            if delay:
+                await trio.sleep(delay)
+            query = message.from_wire(wire)
+            if random.random() < self.error_rate:
+                self.stats_errors += 1
+                res = message.make_response(query)
+                res.set_rcode(rcode.SERVFAIL)
+            else:
+                res = answer(query, self.ttl)
+            data = res.to_wire()
+            async with lock:
+                with suppress(trio.BrokenResourceError, trio.ClosedResourceError):
+                    await stream.send_all(struct.pack(">H", len(data)) + data)
+
+        async with trio.open_nursery() as nursery:
+            buf = b""
+            while not (self.goaway_after and requests >= self.goaway_after):
+                try:
+                    data = await stream.receive_some(65536)
+                except trio.BrokenResourceError:
+                    break
+                if not data:
+                    break
+                buf += data
+                while len(buf) >= 2:
+                    end = 2 + struct.unpack_from(">H", buf)[0]
+                    if len(buf) < end:
+                        break
+                    requests += 1
+                    self.stats_requests += 1
+                    nursery.start_soon(request, buf[2:end])
+                    buf = buf[end:]
+
+    async def serve(self, port, task_status=trio.TASK_STATUS_IGNORED):
+        await self._serve(self._connection, self.ssl, port, task_status)
+
+    async def serve_dot(self, port, task_status=trio.TASK_STATUS_IGNORED):
+        await self._serve(self._dot_connection, self.dot_ssl, port, task_status)
+
+    async def _serve(self, connection, context, port, task_status):
+        async def handler(stream):
+            try:
+                async with stream:
+                    await connection(stream)
+            except trio.BrokenResourceError:
+                pass  # Handshake failed
+
+        listeners = await trio.open_ssl_over_tcp_listeners(
+            port, context, host="127.0.0.1"
+        )
+        task_status.started(listeners[0].transport_listener.socket.getsockname()[1])
+        await trio.serve_listeners(handler, listeners)
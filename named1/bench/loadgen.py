@@ -0,0 +1,118 @@
+import random
+import struct
+import time
+from collections import Counter
+
+import trio
+from dns import message, rcode
+
+
+def _percentile(ordered, p):
+    if not ordered:
+        return float("nan")
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def report(latencies, sent, duration, rcodes):
+    """Summary of a load run with exact latency percentiles in milliseconds."""
+    ordered = sorted(latencies)
+    return dict(
+        sent=sent,
+        answered=len(ordered),
+        lost=sent - len(ordered),
+        qps=round(len(ordered) / duration, 1) if duration else 0.0,
+        **{
+            f"p{p}_ms": round(_percentile(ordered, p) * 1000, 3)
+            for p in (50, 95, 99, 100)
+        },
+        rcodes={rcode.to_text(k): v for k, v in rcodes.items()},
+    )
+
+
+async def load(
+    server,
+    names,
+    type="A",
+    concurrency=50,
+    duration=None,
+    count=None,
+    timeout=2.0,
+):
+    """Send queries over UDP like dnsperf: keep a fixed number of queries in
+    flight, cycling through names, until duration (s) or count queries sent.
+    Unanswered queries count as lost after timeout seconds."""
+    family = trio.socket.AF_INET6 if ":" in server[0] else trio.socket.AF_INET
+    sock = trio.socket.socket(family, trio.socket.SOCK_DGRAM)
+    queries = [message.make_query(n, type).to_wire() for n in names]
+    waiting = {}  # query id -> (event, [reply])
+    latencies, rcodes = [], Counter()
+    sent = 0
+    start = time.monotonic()
+    end = start + duration if duration else float("inf")
+
+    async def receiver():
+        while True:
+            data = await sock.recv(65535)
+            if len(data) < 12:
+                continue
+            qid, flags = struct.unpack("!HH", data[:4])
+            w = waiting.pop(qid, None)
+            if w:
+                w[1].append(flags & 0xF)
+                w[0].set()
+
+    async def client():
+        nonlocal sent
+        while time.monotonic() < end and (count is None or sent < count):
+            query = queries[sent % len(queries)]
+            sent += 1
+            qid = random.randrange(65536)
+            while qid in waiting:
+                qid = random.randrange(65536)
+            w = waiting[qid] = trio.Event(), []
+            t = time.monotonic()
+            await sock.sendto(struct.pack("!H", qid) + query[2:], server)
+            with trio.move_on_after(timeout):
+                await w[0].wait()
+            if w[1]:
+                latencies.append(time.monotonic() - t)
+                rcodes[w[1][0]] += 1
+            else:
+                waiting.pop(qid, None)
+
+    with sock:
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(receiver)
+            async with trio.open_nursery() as clients:
+                for _ in range(concurrency):
+                    clients.start_soon(client)
+            nursery.cancel_scope.cancel()
+    return report(latencies, sent, time.monotonic() - start, rcodes)
+
+
+def main():
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="UDP DNS load generator")
+    parser.add_argument("names", nargs="+", help="Names to query, cycled through")
+    parser.add_argument("-s", "--server", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=53)
+    parser.add_argument("-t", "--type", default="A")
+    parser.add_argument("-c", "--concurrency", type=int, default=50)
+    parser.add_argument("-l", "--duration", type=float, default=10.0)
+    args = parser.parse_args()
+    res = trio.run(
+        lambda: load(
+            (args.server, args.port),
+            args.names,
+            args.type,
+            args.concurrency,
+            duration=args.duration,
+        )
+    )
+    print(json.dumps(res, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Memory per entry and lookup time of a blocklist, compiled index versus a set
+of names."""
+
+import os
+import random
+import resource
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from named1 import policy
+
+
+def _names(count):
+    rnd = random.Random(1)
+    letters = string.ascii_lowercase + string.digits
+    tlds = "com", "net", "org", "io", "info"
+    for i in range(count):
+        label = "".join(rnd.choices(letters, k=rnd.randint(4, 12)))
+        yield f"ads{i}.{label}.{rnd.choice(tlds)}"
+
+
+def _time(f, queries):
+    start = time.perf_counter()
+    for q in queries:
+        f(q)
+    return (time.perf_counter() - start) / len(queries) * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "blocklist.txt")
+        with open(path, "w") as f:
+            f.writelines(f"0.0.0.0 {n}\n" for n in _names(count))
+        print(f"{count} domains, list file {os.path.getsize(path) / count:.1f} B/entry")
+
+        start = time.perf_counter()
+        b = policy.Blocklist(path, policy._stamp(path))
+        print(f"compiled in {time.perf_counter() - start:.1f} s")
+        start = time.perf_counter()
+        b = policy.Blocklist(path, policy._stamp(path))
+        print(f"opened in {(time.perf_counter() - start) * 1000:.1f} ms")
+        size = os.path.getsize(path + ".idx")
+        print(f"index: {size / count:.1f} B/entry (mmap, shared by workers)")
+        policy.loaded = {path: b}
+
+        tracemalloc.start()
+        names = set(_names(count))
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"set of str: {current / count:.1f} B/entry")
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f"peak RSS {rss / 1024:.0f} MB")
+
+        def in_set(name):
+            labels = name.rstrip(".").lower().split(".")
+            return any(".".join(labels[i:]) in names for i in range(len(labels)))
+
+        rnd = random.Random(2)
+        hits = [f"x.{n}." for n in rnd.sample(sorted(names), 10000)]
+        misses = [f"www.example{i}.com." for i in range(10000)]
+        print(f"{'lookup':12}{'set':>10}{'index':>10}")
+        for label, queries in ("blocked", hits), ("not blocked", misses):
+            assert all(policy.blocked(q) == in_set(q) for q in queries[:100])
+            print(
+                f"{label:12}{_time(in_set, queries):8.2f}µs"
+                f"{_time(policy.blocked, queries):8.2f}µs"
+            )
+
+
+if __name__ == "__main__":
+    main()
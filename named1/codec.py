@@ -0,0 +1,210 @@
+"""Fast path for parsing common queries and building their responses directly
+in wire format. Anything unusual returns None, and dnspython is used instead."""
+
+import socket
+import struct
+
+header = struct.Struct(">6H")
+record = struct.Struct(">HHIH")  # Type, class, TTL, RDATA length (after name)
+flag_bits = dict(AA=0x0400, TC=0x0200, RD=0x0100, RA=0x0080, AD=0x0020, CD=0x0010)
+name_chars = frozenset(
+    b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_*"
+)
+our_payload = 8192
+
+_buffer = bytearray()  # Reused for building every response
+
+
+def parse_query(data):
+    """Parse a standard query with one question, returns (id, flags, name,
+    type, end of question, EDNS) where EDNS is None or (payload, DO, NSID)."""
+    try:
+        view = memoryview(data)
+        qid, flags, qdcount, ancount, nscount, arcount = header.unpack_from(view)
+        if flags & 0xF800 or qdcount != 1 or ancount or nscount or arcount > 1:
+            return None  # Not a standard query
+        labels, pos = [], 12
+        while view[pos]:
+            length = view[pos]
+            label = view[pos + 1 : pos + 1 + length]
+            if length > 63 or not name_chars.issuperset(label):
+                return None  # Compression or characters that need escaping
+            labels.append(bytes(label).decode())
+            pos += 1 + length
+        qtype, qclass = struct.unpack_from(">HH", view, pos + 1)
+        end = pos + 5
+        if qclass != 1:
+            return None
+        edns = None
+        if arcount:
+            if view[end] or view[end + 1 : end + 3] != b"\0\x29":
+                return None
+            payload, ttl, rdlen = struct.unpack_from(">HIH", view, end + 3)
+            pos, nsid = end + 11, False
+            if pos + rdlen != len(view) or ttl & 0xFFFF0000:
+                return None  # Extended rcode or EDNS version we don't handle
+            while pos < len(view):
+                code, length = struct.unpack_from(">HH", view, pos)
+                if code == 12:
+                    return None  # Padding needs the response padded too
+                nsid = nsid or code == 3
+                pos += 4 + length
+            edns = payload, bool(ttl & 0x8000), nsid
+        elif end != len(view):
+            return None
+        return qid, flags, ".".join(labels) + ".", qtype, end, edns
+    except (IndexError, struct.error, UnicodeDecodeError):
+        return None
+
+
+def _name(buf, text, compress):
+    """Append a domain name with compression, False if it needs escaping."""
+    if "\\" in text:
+        return False
+    labels = text.rstrip(".").split(".") if text not in (".", "") else []
+    for i in range(len(labels)):
+        suffix = ".".join(labels[i:]).lower()
+        pointer = compress.get(suffix)
+        if pointer is not None:
+            buf += struct.pack(">H", 0xC000 | pointer)
+            return True
+        if len(buf) < 0x4000:
+            compress[suffix] = len(buf)
+        label = labels[i].encode()
+        if not label or len(label) > 63:
+            return False
+        buf.append(len(label))
+        buf += label
+    buf.append(0)
+    return True
+
+
+def _strings(buf, text):
+    """Append TXT character strings, False if escapes are used."""
+    if "\\" in text:
+        return False
+    if text.startswith('"'):
+        parts = text.split('"')
+        if len(parts) % 2 == 0 or any(p.strip() for p in parts[::2]):
+            return False
+        strings = parts[1::2]
+    else:
+        strings = text.split()
+    for s in strings:
+        s = s.encode()
+        if len(s) > 255:
+            return False
+        buf.append(len(s))
+        buf += s
+    return True
+
+
+def _rdata(buf, type, text, compress):
+    """Append RDATA in wire format, False if the type is not supported."""
+    if type == 1:
+        buf += socket.inet_pton(socket.AF_INET, text)
+    elif type == 28:
+        buf += socket.inet_pton(socket.AF_INET6, text)
+    elif type in (2, 5, 12):  # NS, CNAME, PTR
+        return _name(buf, text, compress)
+    elif type == 15:  # MX
+        preference, exchange = text.split()
+        buf += struct.pack(">H", int(preference))
+        return _name(buf, exchange, compress)
+    elif type == 6:  # SOA
+        mname, rname, *numbers = text.split()
+        if not (_name(buf, mname, compress) and _name(buf, rname, compress)):
+            return False
+        buf += struct.pack(">5I", *map(int, numbers))
+    elif type == 16:  # TXT
+        return _strings(buf, text)
+    else:
+        return False
+    return True
+
+
+def _opt(buf, do, nsid):
+    """Append our OPT record, with NSID if given."""
+    options = struct.pack(">HH", 3, len(nsid)) + nsid if nsid is not None else b""
+    buf += b"\0" + record.pack(41, our_payload, 0x8000 if do else 0, len(options))
+    buf += options
+
+
+def response(data, query, res, nsid=None):
+    """Response to a query parsed by parse_query from an answer dict in the
+    format of the JSON API (or with the upstream wire response as Wire).
+    Returns None if dnspython is needed to build it."""
+    try:
+        if "Wire" in res:
+            return _rewrap(data, query, res["Wire"], nsid)
+        return _build(data, query, res, nsid)
+    except (KeyError, TypeError, ValueError, OSError, IndexError, struct.error):
+        return None
+
+
+def _build(data, query, res, nsid):
+    qid, qflags, qname, _, qend, edns = query
+    status = res.get("Status", 0)
+    if not 0 <= status < 16:
+        return None
+    flags = 0x8000 | qflags & 0x0100 | status
+    for k, bit in flag_bits.items():
+        if res.get(k) is True:
+            flags |= bit
+    buf = _buffer
+    del buf[:]
+    buf += bytes(12)
+    buf += data[12:qend]
+    compress = {}
+    _name(bytearray(12), qname, compress)  # Suffixes of the question at offset 12
+    counts = []
+    for section in ("Answer", "Authority", "Additional"):
+        records = res.get(section) or []
+        for a in records:
+            if not _name(buf, a["name"], compress):
+                return None
+            start = len(buf)
+            buf += record.pack(a["type"], 1, max(0, a.get("TTL", 0)), 0)
+            if not _rdata(buf, a["type"], a["data"], compress):
+                return None
+            struct.pack_into(">H", buf, start + 8, len(buf) - start - 10)
+        counts.append(len(records))
+    if edns:
+        _opt(buf, False, nsid)
+        counts[2] += 1
+    header.pack_into(buf, 0, qid, flags, 1, *counts)
+    return bytes(buf)
+
+
+def _rewrap(data, query, wire, nsid):
+    """Upstream response with the client's ID, question and EDNS."""
+    qid, _, _, _, qend, edns = query
+    view = memoryview(wire)
+    _, flags, qdcount, ancount, nscount, arcount = header.unpack_from(view)
+    if qdcount != 1 or bytes(view[12:qend]).lower() != bytes(data[12:qend]).lower():
+        return None  # Different question, the offsets of the records would change
+    pos = qend
+    for _ in range(ancount + nscount + arcount):
+        start = pos
+        while view[pos] and view[pos] < 0xC0:
+            pos += 1 + view[pos]
+        pos += 2 if view[pos] else 1
+        rtype, _, _, rdlen = record.unpack_from(view, pos)
+        pos += 10 + rdlen
+        if rtype == 41:
+            if pos != len(view):
+                return None  # Only a final OPT can be removed safely
+            end, arcount = start, arcount - 1
+            break
+    else:
+        end = pos
+    buf = _buffer
+    del buf[:]
+    buf += bytes(12)
+    buf += data[12:qend]
+    buf += view[qend:end]
+    if edns:
+        _opt(buf, edns[1], nsid)
+        arcount += 1
+    header.pack_into(buf, 0, qid, flags, 1, ancount, nscount, arcount)
+    return bytes(buf)
@@ -0,0 +1,102 @@
+from collections import deque
+
+from named1 import metrics
+
+window = 256  # Recent latencies kept per provider and connection
+min_samples = 20  # Use default_delay until this many latencies are known
+hedge_percentile = 90  # Send the next request once this share has been answered
+default_delay = 0.1
+min_delay = 0.005
+max_delay = 1.0
+ewma_weight = 0.1  # Of each new latency in the average that providers are ranked by
+# Token bucket limiting hedged requests to a share of the queries sent upstream
+hedge_rate = 0.1
+hedge_burst = 20.0
+
+latencies = {}  # name -> Latency
+tokens = hedge_burst
+stats_hedges = stats_hedges_denied = 0
+
+
+class Latency:
+    """Rolling window of recent latencies, with percentiles cached, and a
+    moving average that follows changes faster."""
+
+    __slots__ = ("samples", "changes", "cache", "average")
+
+    def __init__(self):
+        self.samples = deque(maxlen=window)
+        self.changes = 0
+        self.cache = {}
+        self.average = None
+
+    def observe(self, value):
+        if self.average is None:
+            self.average = value
+        else:
+            self.average += (value - self.average) * ewma_weight
+        self.samples.append(value)
+        self.changes += 1
+        # Sorting is cheap but not free, recompute after enough changes
+        if self.changes >= 16 or len(self.samples) <= min_samples:
+            self.changes = 0
+            self.cache.clear()
+
+    def percentile(self, p):
+        """Latency of the p-th percentile, or None if too few samples."""
+        if len(self.samples) < min_samples:
+            return None
+        value = self.cache.get(p)
+        if value is None:
+            ordered = sorted(self.samples)
+            value = self.cache[p] = ordered[
+                min(len(ordered) - 1, p * len(ordered) // 100)
+            ]
+        return value
+
+
+def latency(name):
+    """Latency window by name, created on first use."""
+    w = latencies.get(name)
+    if w is None:
+        w = latencies[name] = Latency()
+    return w
+
+
+def delay(*windows):
+    """Seconds to wait before hedging, from the first window with enough data."""
+    for w in windows:
+        value = w.percentile(hedge_percentile)
+        if value is not None:
+            return min(max_delay, max(min_delay, value))
+    return default_delay
+
+
+def earn():
+    """Called for each query sent upstream, each earning a fraction of a hedge."""
+    global tokens
+    tokens = min(hedge_burst, tokens + hedge_rate)
+
+
+def allow():
+    """Whether a hedged request may be sent now, consuming a token."""
+    global tokens, stats_hedges, stats_hedges_denied
+    if tokens >= 1:
+        tokens -= 1
+        stats_hedges += 1
+        return True
+    stats_hedges_denied += 1
+    return False
+
+
+def collect_metrics():
+    ret = [
+        ("named1_hedges_total", {}, stats_hedges),
+        ("named1_hedges_denied_total", {}, stats_hedges_denied),
+    ]
+    for name, w in latencies.items():
+        ret.append(("named1_hedge_delay_seconds", dict(resolver=name), delay(w)))
+    return ret
+
+
+metrics.collectors.append(collect_metrics)
@@ -0,0 +1,130 @@
+import bisect
+import json
+
+import trio
+
+# Upper bounds of latency histogram buckets, in seconds
+buckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+histograms = {}  # (name, labels) -> Histogram
+collectors = []  # Functions returning [(name, labels, value), ...] when scraped
+
+
+class Histogram:
+    """Fixed-bucket histogram, cheap enough to observe every query."""
+
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(buckets, value)] += 1
+        self.sum += value
+
+    def percentile(self, p):
+        """Upper bound of the bucket containing the p-th percentile."""
+        remaining = p / 100 * sum(self.counts)
+        if not remaining:
+            return float("nan")
+        for bound, count in zip(buckets, self.counts):
+            remaining -= count
+            if remaining <= 0:
+                return bound
+        return float("inf")
+
+
+def histogram(name, **labels):
+    """Histogram by name and labels, created on first use."""
+    key = name, tuple(labels.items())
+    h = histograms.get(key)
+    if h is None:
+        h = histograms[key] = Histogram()
+    return h
+
+
+def _number(value):
+    """Prometheus representation of NaN and infinity."""
+    return "NaN" if value != value else "+Inf" if value == float("inf") else value
+
+
+def _labels(labels, **extra):
+    labels = {**dict(labels), **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+def prometheus():
+    """All metrics in Prometheus text exposition format."""
+    lines = []
+    for (name, labels), h in histograms.items():
+        total = 0
+        for bound, count in zip((*buckets, "+Inf"), h.counts):
+            total += count
+            lines.append(f"{name}_bucket{_labels(labels, le=bound)} {total}")
+        lines.append(f"{name}_sum{_labels(labels)} {h.sum}")
+        lines.append(f"{name}_count{_labels(labels)} {total}")
+        for p in (50, 95, 99):
+            lines.append(f"{name}_p{p}{_labels(labels)} {_number(h.percentile(p))}")
+    for collect in collectors:
+        for name, labels, value in collect():
+            lines.append(f"{name}{_labels(labels.items())} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def as_json():
+    """All metrics as JSON, with percentiles instead of buckets."""
+    ret = []
+    for (name, labels), h in histograms.items():
+        count = sum(h.counts)
+        ret.append(
+            dict(
+                name=name,
+                labels=dict(labels),
+                count=count,
+                avg=h.sum / count if count else None,
+                **{f"p{p}": _number(h.percentile(p)) for p in (50, 95, 99) if count},
+            )
+        )
+    for collect in collectors:
+        for name, labels, value in collect():
+            ret.append(dict(name=name, labels=labels, value=value))
+    return json.dumps(ret)
+
+
+async def _http_connection(stream):
+    async with stream:
+        request = b""
+        with trio.move_on_after(5):
+            while b"\r\n\r\n" not in request and len(request) < 8192:
+                data = await stream.receive_some(4096)
+                if not data:
+                    break
+                request += data
+        path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b"/"
+        if path.startswith(b"/json"):
+            body, ctype = as_json(), "application/json"
+        else:
+            body, ctype = prometheus(), "text/plain; version=0.0.4"
+        body = body.encode()
+        await stream.send_all(
+            b"HTTP/1.0 200 OK\r\n"
+            + f"Content-Type: {ctype}\r\nContent-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+
+
+async def serve_metrics(port, task_status=trio.TASK_STATUS_IGNORED):
+    """Metrics over HTTP on localhost: Prometheus at /metrics, JSON at /json."""
+
+    async def handler(stream):
+        try:
+            await _http_connection(stream)
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            pass
+
+    listeners = await trio.open_tcp_listeners(port, host="127.0.0.1")
+    print(f"[Metrics] listening on http://127.0.0.1:{port}/metrics")
+    task_status.started()
+    await trio.serve_listeners(handler, listeners)
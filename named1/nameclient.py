@@ -1,40 +1,140 @@
+import base64
 import itertools
 import json
-import math
 import random
 import ssl
+import struct
 import time
+from contextlib import suppress
 from urllib.parse import quote
 
 import h2.connection
+import h2.exceptions
 import trio
+from dns import exception, flags, message
 from h2.events import (
     ConnectionTerminated,
     DataReceived,
+    RemoteSettingsChanged,
     ResponseReceived,
     StreamEnded,
     StreamReset,
 )
 
+from named1 import hedging, metrics
 from named1.dnserror import WontResolve
 
+max_streams = 100  # Per connection, unless the server allows fewer
+# Connections per provider, unless overridden by provider settings
+min_connections = 2
+max_connections = 8
+idle_timeout = 30  # Seconds before closing connections above min_connections
+# Providers close connections after about 200 requests, replace them before that
+max_requests = 100
+stream_timeout = 2  # Seconds without an answer before the connection is dropped
+connect_delay = 0.25  # Seconds before racing another address (RFC 8305)
+connect_timeout = 5
 
-class NameConnection:
-    def __init__(self, name, ip, host, path):
+
+def ssl_context(cafile=None, alpn="h2"):
+    """Client context, shared by a provider's connections for TLS resumption."""
+    ctx = ssl.create_default_context(cafile=cafile)
+    ctx.options |= ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1 | ssl.OP_NO_COMPRESSION
+    ctx.set_ciphers("ECDHE+AESGCM")
+    ctx.verify_mode = ssl.CERT_REQUIRED
+    ctx.set_alpn_protocols([alpn])
+    return ctx
+
+
+async def open_tcp(ips, port):
+    """Connect to whichever address answers first, starting another attempt
+    every connect_delay or as soon as the previous one fails. Returns (ip, stream)."""
+    winner, errors = None, []
+
+    async def attempt(ip, failed):
+        nonlocal winner
+        try:
+            stream = await trio.open_tcp_stream(ip, port)
+        except OSError as e:
+            errors.append(e)
+            failed.set()
+            return
+        if winner:
+            await stream.aclose()
+            return
+        winner = ip, stream
+        nursery.cancel_scope.cancel()
+
+    with trio.move_on_after(connect_timeout):
+        async with trio.open_nursery() as nursery:
+            for ip in ips:
+                failed = trio.Event()
+                nursery.start_soon(attempt, ip, failed)
+                with trio.move_on_after(connect_delay):
+                    await failed.wait()
+    if winner is None:
+        raise OSError(f"Connecting failed: {errors or 'timeout'}")
+    return winner
+
+
+def _records(section):
+    return [
+        dict(
+            name=str(rrset.name),
+            type=int(rrset.rdtype),
+            TTL=rrset.ttl,
+            data=rd.to_text(),
+        )
+        for rrset in section
+        for rd in rrset
+    ]
+
+
+def parse_wire(data):
+    """Convert a wire format response into the same dict format as the JSON
+    API answers, keeping the original message in Wire."""
+    msg = message.from_wire(data)
+    return {
+        "Status": int(msg.rcode()),
+        **{
+            f: bool(msg.flags & getattr(flags, f))
+            for f in ("TC", "RD", "RA", "AD", "CD")
+        },
+        "Question": [
+            dict(name=str(rr.name), type=int(rr.rdtype)) for rr in msg.question
+        ],
+        "Answer": _records(msg.answer),
+        "Authority": _records(msg.authority),
+        "Additional": _records(msg.additional),
+        "Wire": data,
+    }
+
+
+class Connection:
+    """TLS connection to a provider, keeping the requests in flight in streams.
+    Transports implement setup, send_task, recv_task, close_streams and
+    resolve, using start_request and answered around each request."""
+
+    def __init__(
+        self, name, ips, host, port, context=None, session=None, on_retire=None
+    ):
         self.name = name
-        self.ip = ip
+        self.ips = ips
+        self.ip = None  # The one connected to
+        self.port = port
         self.host = host
-        self.path = path
+        self.ssl = context or ssl_context()
+        self.session = session  # TLS session to resume
+        self.on_retire = on_retire
+        self.retiring = False  # Replacement requested, still usable meanwhile
+        self.draining = trio.Event()  # Replaced, closes once streams are done
+        self.recent = hedging.Latency()
         self.streams = {}
+        self.stream_freed = trio.Event()
+        self.queued = 0  # Requests waiting for a stream
+        self.last_used = trio.current_time()
         self.successes = self.attempted = 0
-        self.send_some, self.can_send = trio.open_memory_channel(0)
         self.exited = trio.Event()
-        # SSL context
-        self.ssl = ssl.create_default_context()
-        self.ssl.options |= ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1 | ssl.OP_NO_COMPRESSION
-        self.ssl.set_ciphers("ECDHE+AESGCM")
-        self.ssl.verify_mode = ssl.CERT_REQUIRED
-        self.ssl.set_alpn_protocols(["h2"])
 
     async def cancel(self):
         self.connection.cancel()
@@ -44,15 +144,30 @@ class NameConnection:
         with trio.CancelScope() as self.connection:
             self.duration = None
             t = time.monotonic()
-            print(f"[{self.name}] Trying {self.ip}", end="\033[K\r", flush=True)
-            async with await trio.open_tcp_stream(self.ip, 443) as sock:
+            print(
+                f"[{self.name}] Trying {', '.join(self.ips)}",
+                end="\033[K\r",
+                flush=True,
+            )
+            self.ip, sock = await open_tcp(self.ips, self.port)
+            async with sock:
                 sock = trio.SSLStream(
                     sock,
                     server_hostname=self.host,
                     https_compatible=True,
                     ssl_context=self.ssl,
                 )
-                await sock.do_handshake()
+                if self.session:
+                    sock.session = self.session
+                with trio.fail_after(connect_timeout):
+                    await sock.do_handshake()
+                self.resumed = sock.session_reused
+                metrics.histogram("named1_connect_seconds", provider=self.name).observe(
+                    time.monotonic() - t
+                )
+                self.latency = metrics.histogram(
+                    "named1_connection_seconds", provider=self.name, ip=self.ip
+                )
                 cert = sock.getpeercert().get("subject")
                 cert = (
                     cert
@@ -60,25 +175,23 @@ class NameConnection:
                     or "not validated"
                 )
                 self.sock = sock
-                self.conn = h2.connection.H2Connection(
-                    config=h2.config.H2Configuration(
-                        client_side=True, header_encoding="UTF-8"
-                    )
-                )
-                self.conn.initiate_connection()
-                print(f"[{self.name}] {self.ip} connected, cert {cert}")
+                self.setup()
+                resumed = ", resumed" if self.resumed else ""
+                print(f"[{self.name}] {self.ip} connected, cert {cert}{resumed}")
                 self.reason = None
                 connections.add(self)
                 try:
                     async with trio.open_nursery() as nursery:
-                        task_status.started()
+                        task_status.started(self)
                         nursery.start_soon(self.send_task)
                         nursery.start_soon(self.recv_task)
+                        nursery.start_soon(self.drain_task)
                 finally:
                     with trio.move_on_after(1) as cleanup:
                         cleanup.shield = True
                         connections.remove(self)
                         self.exited.set()
+                        self.free_stream()  # Wake up queued requests to fail
                         self.duration = time.monotonic() - t
                         if self.reason is None:
                             self.reason = (
@@ -94,8 +207,90 @@ class NameConnection:
                         print(
                             f"[{self.name}] {self.ip} {self.reason} after {self.duration:.2f} s, {requests}"
                         )
-                        for stream in list(self.streams.values()):
-                            await stream.aclose()
+                        await self.close_streams()
+
+    async def drain_task(self):
+        """Close after the replacement is up and our last streams are done."""
+        await self.draining.wait()
+        with trio.move_on_after(stream_timeout):
+            while self.streams or self.queued:
+                await self.stream_freed.wait()
+        self.reason = "rotated"
+        self.connection.cancel()
+
+    def capacity(self):
+        """Number of concurrent streams allowed."""
+        return max_streams
+
+    def full(self):
+        return len(self.streams) + self.queued >= self.capacity()
+
+    def free_stream(self):
+        self.stream_freed.set()
+        self.stream_freed = trio.Event()
+
+    async def start_request(self):
+        """Wait for a free stream, retiring the connection after max_requests."""
+        if self.exited.is_set():
+            raise RuntimeError("Connection no longer executing")
+        self.last_used = trio.current_time()
+        if len(self.streams) >= self.capacity():
+            self.queued += 1
+            try:
+                while len(self.streams) >= self.capacity():
+                    await self.stream_freed.wait()
+                    if self.exited.is_set():
+                        raise RuntimeError("Connection no longer executing")
+            finally:
+                self.queued -= 1
+        self.attempted += 1
+        if self.attempted >= max_requests and not self.retiring:
+            self.retiring = True
+            if self.on_retire:
+                self.on_retire()
+
+    def timed_out(self):
+        # The server has stopped responding, don't wait for more requests to fail
+        self.reason = "request timeout"
+        self.connection.cancel()
+
+    def answered(self, data, start_time):
+        data["NameClient"] = self.name
+        self.successes += 1
+        self.latency.observe(trio.current_time() - start_time)
+        self.recent.observe(trio.current_time() - start_time)
+        return data
+
+
+class NameConnection(Connection):
+    """DNS over HTTPS, JSON API or RFC 8484, with requests as HTTP/2 streams."""
+
+    def __init__(
+        self,
+        name,
+        ips,
+        host,
+        path,
+        format="dns-json",
+        port=443,
+        context=None,
+        session=None,
+        on_retire=None,
+    ):
+        super().__init__(name, ips, host, port, context, session, on_retire)
+        self.path = path
+        self.format = format  # dns-json or dns-message (RFC 8484)
+        self.send_some, self.can_send = trio.open_memory_channel(0)
+
+    def setup(self):
+        self.conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=True, header_encoding="UTF-8")
+        )
+        self.conn.initiate_connection()
+
+    async def close_streams(self):
+        for stream in list(self.streams.values()):
+            await stream.aclose()
 
     async def send_task(self):
         async for _ in self.can_send:
@@ -110,6 +305,13 @@ class NameConnection:
                 raise RuntimeError("Socket died")
             for event in self.conn.receive_data(data):
                 # print(event)
+                if isinstance(event, DataReceived):
+                    # Keep the flow control windows open, sent on next iteration
+                    self.conn.acknowledge_received_data(
+                        event.flow_controlled_length, event.stream_id
+                    )
+                elif isinstance(event, RemoteSettingsChanged):
+                    self.free_stream()  # Concurrent streams limit may have changed
                 if hasattr(event, "stream_id") and event.stream_id > 0:
                     try:
                         await self.streams[event.stream_id].send(event)
@@ -119,72 +321,164 @@ class NameConnection:
                     self.reason = "ConnectionTerminated"
                     raise RuntimeError("Peer ended the connection")
 
+    def capacity(self):
+        return min(max_streams, self.conn.remote_settings.max_concurrent_streams)
+
     async def resolve(self, **req):
-        if self.exited.is_set():
-            raise RuntimeError("NameConnection no longer executing")
-        while len(self.streams) > 3:
-            await trio.sleep(0.01)
-        self.connection.deadline = min(
-            self.connection.deadline, trio.current_time() + 2
-        )
-        self.attempted += 1
+        await self.start_request()
         num = self.conn.get_next_available_stream_id()
+        if self.format == "dns-message":
+            query = message.make_query(
+                str(req["name"]), req["type"], want_dnssec=req.get("do") == "1"
+            )
+            query.id = 0  # RFC 8484 4.1: for HTTP cache friendliness
+            query = base64.urlsafe_b64encode(query.to_wire()).rstrip(b"=")
+            path = f"{self.path}?dns={query.decode()}"
+        else:
+            path = f"{self.path}?{'&'.join(f'{k}={quote(str(v))}' for k, v in req.items())}"
         sender, receiver = trio.open_memory_channel(0)
+        start_time = trio.current_time()
         async with receiver:
-            self.conn.send_headers(
-                num,
-                headers=(
-                    (":scheme", "https"),
-                    (":authority", self.host),
-                    (":method", "GET"),
-                    (
-                        ":path",
-                        f"{self.path}?{'&'.join(f'{k}={quote(str(v))}' for k, v in req.items())}",
-                    ),
-                    ("accept", "application/dns-json"),
-                    (
-                        "user-agent",
-                        "Python Trio H2 Named1 (+https://github.com/Tronic/named1)",
+            try:
+                self.conn.send_headers(
+                    num,
+                    headers=(
+                        (":scheme", "https"),
+                        (":authority", self.host),
+                        (":method", "GET"),
+                        (":path", path),
+                        ("accept", f"application/{self.format}"),
+                        (
+                            "user-agent",
+                            "Python Trio H2 Named1 (+https://github.com/Tronic/named1)",
+                        ),
                     ),
-                ),
-                end_stream=True,
-            )
+                    end_stream=True,
+                )
+            except h2.exceptions.ProtocolError as e:
+                # GOAWAY received but recv_task has not yet closed us
+                raise RuntimeError(f"Connection closing: {e}")
             self.streams[num] = sender
             await self.send_some.send(True)
             headers, data, done = [], b"", False
             try:
-                async for event in receiver:
-                    if isinstance(event, Exception):
-                        raise event
-                    elif isinstance(event, ResponseReceived):
-                        headers += event.headers
-                    elif isinstance(event, DataReceived):
-                        data += event.data
-                    elif isinstance(event, StreamEnded):
-                        done = True
-                        break
-                    elif isinstance(event, StreamReset):
-                        break
+                with trio.move_on_after(stream_timeout) as timeout:
+                    async for event in receiver:
+                        if isinstance(event, Exception):
+                            raise event
+                        elif isinstance(event, ResponseReceived):
+                            headers += event.headers
+                        elif isinstance(event, DataReceived):
+                            data += event.data
+                        elif isinstance(event, StreamEnded):
+                            done = True
+                            break
+                        elif isinstance(event, StreamReset):
+                            break
             finally:
                 del self.streams[num]
+                self.free_stream()
+        if timeout.cancelled_caught:
+            self.timed_out()
         if not done:
             raise RuntimeError(f"Stream {num} terminated prior to request completion")
         headers = dict(headers)
         status, ctype = headers.get(":status"), headers.get("content-type", "")
         if status != "200":
             raise RuntimeError(f"HTTP {status}: {data}")
-        if "javascript" not in ctype and "json" not in ctype:
+        if self.format == "dns-message":
+            if ctype != "application/dns-message":
+                raise RuntimeError(f"Unexpected content-type {ctype}")
+            try:
+                data = parse_wire(data)
+            except exception.DNSException as e:
+                raise RuntimeError(f"Malformed DNS message: {e!r}") from e
+        elif "javascript" not in ctype and "json" not in ctype:
             raise RuntimeError("Non-JSON response")
-        data = json.loads(data.decode("ASCII"))  # RFC 8427 1.1: ASCII only
+        else:
+            try:
+                data = json.loads(data.decode("ASCII"))  # RFC 8427 1.1: ASCII only
+            except ValueError as e:
+                raise RuntimeError(f"Malformed JSON: {e!r}") from e
         if not isinstance(data, dict):
             raise RuntimeError("Incorrect JSON format received")
-        data["NameClient"] = self.name
-        if data:
-            self.successes += 1
-            # Extend deadline; Cloudflare and Google die after about 200 so don't bother after 100.
-            if self.attempted < 100:
-                self.connection.deadline += 10 if self.streams else math.inf
-        return data
+        return self.answered(data, start_time)
+
+
+class DoTConnection(Connection):
+    """DNS over TLS (RFC 7858): queries pipelined on the stream with a length
+    prefix, answers matched by message ID in whatever order they arrive."""
+
+    def __init__(
+        self, name, ips, host, port=853, context=None, session=None, on_retire=None
+    ):
+        super().__init__(name, ips, host, port, context, session, on_retire)
+        self.outgoing = bytearray()  # Queries not yet sent, written together
+        self.wakeup = trio.Event()
+
+    def setup(self):
+        pass
+
+    async def close_streams(self):
+        for waiter in self.streams.values():
+            waiter[0].set()  # Without an answer
+
+    async def send_task(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup = trio.Event()
+            data, self.outgoing = self.outgoing, bytearray()
+            await self.sock.send_all(data)
+
+    async def recv_task(self):
+        buf = b""
+        while True:
+            data = await self.sock.receive_some(65536)
+            if not data:
+                self.reason = "closed by server"
+                raise RuntimeError("Socket closed")
+            buf += data
+            while len(buf) >= 2:
+                end = 2 + struct.unpack_from(">H", buf)[0]
+                if len(buf) < end:
+                    break
+                wire, buf = buf[2:end], buf[end:]
+                waiter = self.streams.get(struct.unpack_from(">H", wire)[0])
+                if waiter and not waiter[0].is_set():
+                    waiter.append(wire)
+                    waiter[0].set()
+
+    async def resolve(self, **req):
+        await self.start_request()
+        query = message.make_query(
+            str(req["name"]), req["type"], want_dnssec=req.get("do") == "1"
+        )
+        while query.id in self.streams:
+            query.id = random.getrandbits(16)
+        wire = query.to_wire()
+        self.streams[query.id] = waiter = [trio.Event()]
+        self.outgoing += struct.pack(">H", len(wire)) + wire
+        self.wakeup.set()
+        start_time = trio.current_time()
+        try:
+            with trio.move_on_after(stream_timeout) as timeout:
+                await waiter[0].wait()
+        finally:
+            del self.streams[query.id]
+            self.free_stream()
+        if timeout.cancelled_caught:
+            self.timed_out()
+        if len(waiter) < 2:
+            raise RuntimeError(f"Query {query.id} terminated prior to completion")
+        try:
+            data = parse_wire(waiter[1])
+        except exception.DNSException as e:
+            raise RuntimeError(f"Malformed DNS message: {e!r}") from e
+        q = query.question[0]
+        question = [(a["name"].lower(), a["type"]) for a in data["Question"]]
+        if question != [(str(q.name).lower(), q.rdtype)]:
+            raise RuntimeError(f"Answer to another question: {question}")
+        return self.answered(data, start_time)
 
 
 class NameClient:
@@ -192,67 +486,194 @@ class NameClient:
         self.name = name
         self.servers = servers
         self.connections = set()
+        self.min_connections = servers.get("min_connections", min_connections)
+        self.max_connections = servers.get("max_connections", max_connections)
+        self.target = self.min_connections
+        self.pool_changed = trio.Event()
+        self.waiting = set()  # Senders of requests waiting for a connection
+        self.transport = servers.get("transport", "https")
+        self.ssl = ssl_context(
+            servers.get("cafile"), "dot" if self.transport == "dot" else "h2"
+        )
+        self.stats_connects = self.stats_closed_requests = 0
+        self.stats_rotations = self.stats_resumed = 0
 
-    async def execute(self):
-        ip = itertools.cycle(self.servers["ipv6"] + self.servers["ipv4"])
+    def active(self):
+        """Connections not waiting to be replaced."""
+        return {c for c in self.connections if not c.retiring}
 
+    def available(self, exclude=()):
+        """Connections for new requests, preferring the ones not retiring."""
+        connections = [
+            c for c in self.connections if c not in exclude and not c.draining.is_set()
+        ]
+        return [c for c in connections if not c.retiring] or connections
+
+    def addresses(self):
+        """IPv6 and IPv4 addresses interleaved, starting from a different one
+        on each connect to spread connections over the servers."""
+        pairs = itertools.zip_longest(self.servers["ipv6"], self.servers["ipv4"])
+        ips = [ip for pair in pairs for ip in pair if ip]
+        n = self.stats_connects % len(ips)
+        return ips[n:] + ips[:n]
+
+    def collect_metrics(self):
+        labels = dict(provider=self.name)
+        requests = self.stats_closed_requests
+        requests += sum(c.attempted for c in self.connections)
+        return [
+            ("named1_connections", labels, len(self.connections)),
+            ("named1_connects_total", labels, self.stats_connects),
+            ("named1_tls_resumed_total", labels, self.stats_resumed),
+            ("named1_rotations_total", labels, self.stats_rotations),
+            ("named1_connections_target", labels, self.target),
+            ("named1_streams", labels, sum(len(c.streams) for c in self.connections)),
+            ("named1_streams_queued", labels, sum(c.queued for c in self.connections)),
+            ("named1_stream_requests_total", labels, requests),
+        ]
+
+    async def execute(self):
         async def run_connection(task_status):
-            nonlocal ip, cancel_scope
-            connection = NameConnection(
-                self.name, next(ip), self.servers["host"], self.servers["path"]
+            # Resume the session of a connection that has already received tickets
+            session = next(
+                (c.sock.session for c in self.connections if c.successes), None
             )
+            if self.transport == "dot":
+                connection = DoTConnection(
+                    self.name,
+                    self.addresses(),
+                    self.servers["host"],
+                    self.servers.get("port", 853),
+                    self.ssl,
+                    session,
+                    on_retire=lambda: self.pool_changed.set(),
+                )
+            else:
+                connection = NameConnection(
+                    self.name,
+                    self.addresses(),
+                    self.servers["host"],
+                    self.servers["path"],
+                    self.servers.get("format", "dns-json"),
+                    self.servers.get("port", 443),
+                    self.ssl,
+                    session,
+                    on_retire=lambda: self.pool_changed.set(),
+                )
+            self.stats_connects += 1
             try:
                 await connection.execute(self.connections, task_status=task_status)
             except Exception:
                 pass  # Ignore errors, we will reconnect
+            self.stats_closed_requests += connection.attempted
             if connection.successes == 0:
                 # Scatter reconnection times after disconnection
                 await trio.sleep(1 + random.random())
-            cancel_scope.cancel()  # Trigger reconnection
+            self.pool_changed.set()  # Trigger reconnection
 
-        # Try to keep two connections alive at all times
+        # Keep the target number of connections alive at all times, replacing
+        # retiring connections before draining them (make-before-break)
         async with trio.open_nursery() as nursery:
+            nursery.start_soon(self.shrink_task)
             while True:
-                with trio.CancelScope() as cancel_scope:
-                    while len(self.connections) < 2:
-                        try:
-                            # Returns once NameConnection has added itself to self.connections, or connection fails
-                            await nursery.start(run_connection)
-                        except RuntimeError:
-                            pass
-                    await trio.sleep_forever()
+                while len(self.active()) < self.target:
+                    try:
+                        # Returns once the connection has added itself to self.connections, or connection fails
+                        connection = await nursery.start(run_connection)
+                    except RuntimeError:
+                        continue
+                    self.stats_resumed += connection.resumed
+                    waiting, self.waiting = self.waiting, set()
+                    for sender in waiting:
+                        with suppress(trio.WouldBlock, trio.BrokenResourceError):
+                            sender.send_nowait(None)  # Try the new connection
+                for c in self.connections - self.active():
+                    if not c.draining.is_set():
+                        self.stats_rotations += 1
+                        c.draining.set()
+                await self.pool_changed.wait()
+                self.pool_changed = trio.Event()
+
+    def grow(self):
+        """Add a connection because requests are queueing for streams."""
+        # Only one at a time, the previous one may still be connecting
+        if self.target <= len(self.active()) and self.target < self.max_connections:
+            self.target += 1
+            self.pool_changed.set()
+
+    async def shrink_task(self):
+        """Close connections above the minimum once they have been idle."""
+        while True:
+            await trio.sleep(idle_timeout / 3)
+            idle_since = trio.current_time() - idle_timeout
+            for c in self.active():
+                if self.target <= self.min_connections:
+                    break
+                if not c.streams and c.last_used < idle_since:
+                    self.target -= 1
+                    c.connection.cancel()
 
     async def resolve(self, name, type="A", **kwargs):
-        """Try resolving using any available connections. New requests are made
-        at short intervals if other servers are available, without interrupting
-        prior requests. The first reply is returned and then all remaining
-        requests are terminated. Total timeout 0.9 seconds."""
+        """Try resolving using any available connections. Another connection
+        is tried, without interrupting prior requests, once the current one
+        has taken longer than most of its recent requests (and if the hedging
+        budget allows). The first reply is returned and then all remaining
+        requests are terminated."""
         tried_connections = set()
         sender, receiver = trio.open_memory_channel(50)
         request_exceptions = []
+        deadline = trio.current_time() + 7
 
         async def resolve_task(resolver):
             try:
                 sender.send_nowait(await resolver)
-            except (RuntimeError, trio.BrokenResourceError) as e:
+            except RuntimeError as e:
+                request_exceptions.append(e)
+                with suppress(trio.BrokenResourceError):
+                    sender.send_nowait(None)  # Wake up to fail over
+            except trio.BrokenResourceError as e:
                 request_exceptions.append(e)
 
-        async with trio.open_nursery() as nursery, receiver:
-            for delay in (0.2, 1, 2, 4):  # Retry until deadline
-                connections = self.connections - tried_connections
-                if connections:
-                    connection = random.choice(list(connections))
-                    tried_connections.add(connection)
-                    nursery.start_soon(
-                        resolve_task, connection.resolve(name=name, type=type, **kwargs)
-                    )
-                with trio.move_on_after(delay):
-                    return await receiver.receive()
-        reason = (
-            f"requests unanswered {len(tried_connections)}"
-            if tried_connections
-            else "waiting for connection"
-        )
+        try:
+            async with trio.open_nursery() as nursery, receiver:
+                while trio.current_time() < deadline:
+                    self.waiting.discard(sender)
+                    delay = float("inf")  # Until an answer, failure or new connection
+                    connections = self.available(exclude=tried_connections)
+                    failed = len(request_exceptions) == len(tried_connections)
+                    if request_exceptions and failed and not connections:
+                        break  # Every connection failed and none is left to try
+                    # Not hedges: the first request, or one once all tried failed
+                    if connections and (failed or hedging.allow()):
+                        connection = min(
+                            connections, key=lambda c: len(c.streams) + c.queued
+                        )
+                        if connection.full():
+                            self.grow()
+                        tried_connections.add(connection)
+                        nursery.start_soon(
+                            resolve_task,
+                            connection.resolve(name=name, type=type, **kwargs),
+                        )
+                        delay = hedging.delay(
+                            connection.recent, hedging.latency(self.name)
+                        )
+                    elif connections:  # Out of hedging budget, check again later
+                        delay = hedging.delay(hedging.latency(self.name))
+                    else:
+                        self.waiting.add(sender)
+                    with trio.move_on_at(min(deadline, trio.current_time() + delay)):
+                        res = await receiver.receive()
+                        if res:
+                            return res
+        finally:
+            self.waiting.discard(sender)
+        if not tried_connections:
+            reason = "waiting for connection"
+        elif len(request_exceptions) == len(tried_connections):
+            reason = f"requests failed {len(tried_connections)}"
+        else:
+            reason = f"requests unanswered {len(tried_connections)}"
         raise WontResolve(f"[{self.name}] {name} timeout {reason}", request_exceptions)
 
     def resolve_reverse(self, ip):
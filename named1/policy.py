@@ -0,0 +1,253 @@
+"""Local answers before the cache and upstream: blocked domains and names
+from hosts files.
+
+Blocklists are compiled into an index of the names with their labels reversed
+(com.example.ads), sorted and stored one after another with a table of their
+offsets. The index is written next to the list and searched by binary search
+through mmap, so that it costs little more than the names themselves, pages in
+only as needed and is shared by workers. A bit filter of name hashes (two bytes
+per name) in front lets most lookups of names not listed skip the search. A
+name is blocked if it or any of its parent domains is listed. Lists are
+reloaded when their files change."""
+
+import ipaddress
+import mmap
+import os
+import struct
+from array import array
+from zlib import crc32
+
+import trio
+
+from named1 import metrics
+
+blocklists = []  # Files of domains, hosts format (0.0.0.0 domain) or ||domain^
+hosts_files = []  # Files in /etc/hosts format, answered as A/AAAA/PTR records
+block_mode = "nxdomain"  # Or "null" to answer 0.0.0.0 and ::
+ttl = 60  # Of local answers
+reload_interval = 10  # Seconds between checks for changed files
+
+index_magic = b"named1 policy 1\n"
+# Source mtime (ns) and size, number of names, size of filter
+index_header = struct.Struct("<qqII")
+
+loaded = {}  # Path -> Blocklist
+hosts = {}  # Name -> {type: [data]}
+stamps = {}  # Path -> (mtime, size) of the version loaded or failed
+stats_blocked = stats_overridden = 0
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def _reverse(name):
+    return ".".join(reversed(name.rstrip(".").lower().split("."))).encode()
+
+
+def _list_names(line):
+    """Domains of a blocklist line."""
+    tokens = line.split("#", 1)[0].split()
+    if not tokens:
+        return []
+    if tokens[0].startswith("||"):  # Adblock style
+        return [tokens[0][2:].split("^", 1)[0]]
+    if len(tokens) > 1:  # Hosts format, the address is ignored
+        return [t for t in tokens[1:] if t != "localhost"]
+    return tokens
+
+
+def compile_index(path, stamp):
+    """Index of a blocklist file, as bytes."""
+    with open(path, encoding="utf-8", errors="replace") as f:
+        keys = sorted({_reverse(n) for line in f for n in _list_names(line) if n})
+    bits = 1 << max(16, (16 * len(keys)).bit_length())
+    bloom = bytearray(bits // 8)
+    for key in keys:
+        h = crc32(key) & bits - 1
+        bloom[h >> 3] |= 1 << (h & 7)
+    offsets = array("I", [0]) * (len(keys) + 1)
+    pos = len(index_magic) + index_header.size + 4 * len(offsets) + len(bloom)
+    for i, key in enumerate(keys):
+        offsets[i] = pos
+        pos += len(key)
+    offsets[len(keys)] = pos
+    header = index_magic + index_header.pack(*stamp, len(keys), len(bloom))
+    return b"".join([header, offsets.tobytes(), bloom, *keys])
+
+
+class Blocklist:
+    """Compiled blocklist, from an index file that is rebuilt if outdated."""
+
+    __slots__ = ("path", "count", "offsets", "bloom", "mask", "data")
+
+    def __init__(self, path, stamp):
+        self.path = path
+        index = path + ".idx"
+        try:
+            with open(index, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+            if not self._open(data, stamp):
+                raise FileNotFoundError
+        except (OSError, ValueError):
+            data = compile_index(path, stamp)
+            try:
+                tmp = f"{index}.{os.getpid()}"
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, index)
+                with open(index, "rb") as f:
+                    data = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+            except OSError:
+                pass  # Not writable, keep the index in memory
+            self._open(data, stamp)
+
+    def _open(self, data, stamp):
+        """Use the index in data if it is of the given version of the list."""
+        pos = len(index_magic) + index_header.size
+        if data[: len(index_magic)] != index_magic:
+            return False
+        *version, count, size = index_header.unpack_from(data, len(index_magic))
+        if tuple(version) != stamp:
+            return False
+        self.count, self.data, self.mask = count, data, size * 8 - 1
+        view = memoryview(data)
+        self.offsets = view[pos : pos + 4 * (count + 1)].cast("I")
+        pos += 4 * (count + 1)
+        self.bloom = view[pos : pos + size]
+        return True
+
+    def __contains__(self, key):
+        h = crc32(key) & self.mask
+        if not self.bloom[h >> 3] >> (h & 7) & 1:
+            return False
+        offsets, data = self.offsets, self.data
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = data[offsets[mid] : offsets[mid + 1]]
+            if entry < key:
+                lo = mid + 1
+            elif entry > key:
+                hi = mid
+            else:
+                return True
+        return False
+
+
+def blocked(name):
+    """Whether name or any of its parents is in a blocklist."""
+    key = b""
+    for label in reversed(name.rstrip(".").lower().split(".")):
+        key = key + b"." + label.encode() if key else label.encode()
+        for b in loaded.values():
+            if key in b:
+                return True
+    return False
+
+
+def read_hosts(paths):
+    """Records of names in hosts files, with PTR records of the addresses."""
+    ret = {}
+    for path in paths:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                tokens = line.split("#", 1)[0].split()
+                try:
+                    ip = ipaddress.ip_address(tokens[0].split("%")[0])
+                except (IndexError, ValueError):
+                    continue
+                type = 28 if ip.version == 6 else 1
+                for n in tokens[1:]:
+                    n = n.rstrip(".").lower() + "."
+                    records = ret.setdefault(n, {}).setdefault(type, [])
+                    if str(ip) not in records:
+                        records.append(str(ip))
+                if len(tokens) > 1:
+                    ptr = ret.setdefault(ip.reverse_pointer + ".", {})
+                    ptr.setdefault(12, [tokens[1].rstrip(".") + "."])
+    return ret
+
+
+def _answer(name, type, status, data):
+    return {
+        "Status": status,
+        "TC": False,
+        "RD": True,
+        "RA": True,
+        "AD": False,
+        "CD": False,
+        "Question": [dict(name=name, type=type)],
+        "Answer": [dict(name=name, type=type, TTL=ttl, data=d) for d in data],
+        "Authority": [],
+        "NameClient": "Policy",
+    }
+
+
+def resolve(name, type, **kwargs):
+    """Local answer to a query, or None if it should be resolved normally."""
+    global stats_blocked, stats_overridden
+    if hosts:
+        records = hosts.get(name.lower())
+        if records is not None:
+            stats_overridden += 1
+            return _answer(name, type, 0, records.get(type, []))
+    if loaded and blocked(name):
+        stats_blocked += 1
+        if block_mode != "null":
+            return _answer(name, type, 3, [])
+        return _answer(name, type, 0, {1: ["0.0.0.0"], 28: ["::"]}.get(type, []))
+    return None
+
+
+async def reload():
+    """Load the files that changed since the last call."""
+    global hosts
+    changed = []
+    for path in [*blocklists, *hosts_files]:
+        try:
+            stamp = _stamp(path)
+        except OSError as e:
+            stamp = e.errno
+        if stamps.get(path) != stamp:
+            stamps[path] = stamp
+            changed.append((path, stamp))
+    for path, stamp in changed:
+        if path in hosts_files:
+            continue
+        try:
+            if isinstance(stamp, int):
+                raise OSError(stamp, os.strerror(stamp))
+            b = await trio.to_thread.run_sync(Blocklist, path, stamp)
+        except OSError as e:
+            print(f"[Policy] {path} could not be loaded: {e}")
+            continue
+        loaded[path] = b
+        print(f"[Policy] {b.count} domains blocked from {path}")
+    if any(path in hosts_files for path, _ in changed):
+        try:
+            hosts = await trio.to_thread.run_sync(read_hosts, hosts_files)
+            print(f"[Policy] {len(hosts)} names from {', '.join(hosts_files)}")
+        except OSError as e:
+            print(f"[Policy] hosts could not be loaded: {e}")
+
+
+async def policy_task():
+    while True:
+        await reload()
+        await trio.sleep(reload_interval)
+
+
+def collect_metrics():
+    ret = [
+        ("named1_policy_blocked_total", {}, stats_blocked),
+        ("named1_policy_overridden_total", {}, stats_overridden),
+        ("named1_policy_hosts_names", {}, len(hosts)),
+    ]
+    for path, b in loaded.items():
+        ret.append(("named1_policy_blocklist_domains", dict(file=path), b.count))
+    return ret
+
+
+metrics.collectors.append(collect_metrics)
@@ -0,0 +1,98 @@
+import heapq
+import math
+
+import trio
+
+from named1 import metrics, ramcache
+
+min_hits = 3  # Cache hits since the last refresh to consider a name popular
+lead_time = 5  # Seconds before expiry when popular names are refreshed
+max_concurrent = 10
+
+schedule = []  # (time, key) of refreshes to be done
+scheduled = set()
+expiring = []  # (time, key) of prefetched answers expiring
+prefetched = {}  # key -> expiry time of answers prefetched but not yet hit
+wakeup = trio.Event()
+stats_prefetches = stats_prefetch_hits = stats_prefetch_waste = 0
+
+
+def _ttl(res):
+    return min(
+        (a.get("TTL", 0) for a in res.get("Answer", []) + res.get("Authority", [])),
+        default=0,
+    )
+
+
+def hit(name, type, res):
+    """Record an answer served by RamCache, scheduling its refresh if popular."""
+    _hit(name, type, res.get("Hits", 0), _ttl(res))
+
+
+def wire_hit(name, type):
+    """Record an answer served from the wire cache of serve53, which repeats
+    answers of RamCache without asking it, as a hit of RamCache."""
+    cached = ramcache.count_hit(name, type)
+    if cached:
+        _hit(name, type, *cached)
+
+
+def _hit(name, type, hits, ttl):
+    global stats_prefetch_hits
+    key = name.lower(), type  # Clients may randomize the case of names
+    if prefetched.pop(key, None):
+        stats_prefetch_hits += 1
+    if hits >= min_hits and key not in scheduled:
+        scheduled.add(key)
+        heapq.heappush(schedule, (trio.current_time() + ttl - lead_time, key))
+        wakeup.set()
+
+
+async def prefetch_task(refresh):
+    """Run refresh(name, type) on popular names shortly before they expire."""
+    global wakeup, stats_prefetches, stats_prefetch_waste
+    limiter = trio.CapacityLimiter(max_concurrent)
+
+    async def prefetch(key):
+        async with limiter:
+            try:
+                res = await refresh(*key)
+            except Exception:
+                return
+            finally:
+                scheduled.discard(key)
+            expire = trio.current_time() + _ttl(res)
+            prefetched[key] = expire
+            heapq.heappush(expiring, (expire, key))
+            wakeup.set()
+
+    async with trio.open_nursery() as nursery:
+        while True:
+            now = trio.current_time()
+            while schedule and schedule[0][0] <= now:
+                _, key = heapq.heappop(schedule)
+                stats_prefetches += 1
+                nursery.start_soon(prefetch, key)
+            while expiring and expiring[0][0] <= now:
+                expire, key = heapq.heappop(expiring)
+                if prefetched.get(key) == expire:  # Never hit after prefetching
+                    del prefetched[key]
+                    stats_prefetch_waste += 1
+            wakeup = trio.Event()
+            deadline = min(
+                schedule[0][0] if schedule else math.inf,
+                expiring[0][0] if expiring else math.inf,
+            )
+            with trio.move_on_at(deadline):
+                await wakeup.wait()
+
+
+def collect_metrics():
+    return [
+        ("named1_prefetches_total", {}, stats_prefetches),
+        ("named1_prefetch_hits_total", {}, stats_prefetch_hits),
+        ("named1_prefetch_wasted_total", {}, stats_prefetch_waste),
+    ]
+
+
+metrics.collectors.append(collect_metrics)
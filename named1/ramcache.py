@@ -1,66 +1,245 @@
+import heapq
+import marshal
+import os
+import struct
+from collections import OrderedDict
 from datetime import datetime
 
+import trio
+
+from named1 import metrics
 from named1.dnserror import WontResolve
 
 name = "RamCache"
-cache_store = {}  # Global dictionary to store records
+max_entries = 100_000  # Least recently used entries are evicted beyond this
+cache_store = OrderedDict()  # Records by name and type, in LRU order
+expiry_heap = []  # (Expiry, key) of stored entries, may contain outdated items
+max_chain = 8  # CNAME hops followed, which also stops loops
+max_ttl = 86400  # Cap for caching records
+max_negative_ttl = 3600  # Cap for caching NXDOMAIN and NODATA answers
+stale_window = 86400  # Expired records are kept this long for serve-stale
+stale_ttl = 30  # RFC 8767 TTL of stale answers
+shared = None  # SharedCache of worker processes, if any
+snapshot_magic = b"named1 RamCache 3\n"  # Followed by length-prefixed chunks
+snapshot_interval = 300  # Seconds between snapshots written by snapshot_task
+snapshot_chunk = 1000  # Entries serialized at a time, between which others run
+stats_evictions = stats_expired = stats_stale = 0
+stats_hits = stats_misses = 0
+
+
+def evict(now):
+    """Remove expired and least recently used entries from cache."""
+    global expiry_heap, stats_evictions, stats_expired
+    while expiry_heap and expiry_heap[0][0] < now:
+        expiry, key = heapq.heappop(expiry_heap)
+        cached = cache_store.get(key)
+        # Entries updated since this heap item was pushed have newer heap items
+        if cached and cached["Expiry"] == expiry:
+            del cache_store[key]
+            stats_expired += 1
+    while len(cache_store) > max_entries:
+        cache_store.popitem(last=False)
+        stats_evictions += 1
+    # Drop heap items of updated or evicted entries once they dominate the heap
+    if len(expiry_heap) > 2 * len(cache_store) + 1000:
+        expiry_heap = [(c["Expiry"], k) for k, c in cache_store.items()]
+        heapq.heapify(expiry_heap)
+
+
+def store(key, entry, old, now):
+    entry["Expiry"] = expiry = min(now + max_ttl, entry["Expiry"]) + stale_window
+    cache_store[key] = entry
+    cache_store.move_to_end(key)
+    if expiry != old.get("Expiry"):
+        heapq.heappush(expiry_heap, (expiry, key))
+    if shared:
+        shared.put(key, entry)
+
 
+def load_shared(key):
+    """Take an entry stored by another worker if it is newer than ours."""
+    entry = shared.get(key)
+    if not entry or entry["Expiry"] <= cache_store.get(key, {}).get("Expiry", 0):
+        return False
+    cache_store[key] = entry
+    cache_store.move_to_end(key)
+    heapq.heappush(expiry_heap, (entry["Expiry"], key))
+    return True
 
-async def cache(qr):
-    global cache_store
-    name = qr["Question"][0]["name"]
-    key = f"dns:{name}"
-    if not qr.get("Answer"):
+
+def _key(name, type):
+    """Entries are indexed by name and type, with type 0 for NXDOMAIN."""
+    return f"dns:{str(name).lower()}:{type}"
+
+
+def cache_records(name, type, records, now):
+    """Merge [expire, data] records of an RRset into its entry."""
+    key = _key(name, type)
+    old = cache_store.get(key, {})
+    merger = {data: expire for expire, data in old.get("Answer", ())}
+    for expire, data in records:
+        if merger.get(data, 0) < expire:
+            merger[data] = expire
+    horizon = now - stale_window  # Records expired before this are dropped
+    answer = [[expire, data] for data, expire in merger.items() if expire > horizon]
+    store(key, {"Answer": answer, "Expiry": max(merger.values())}, old, now)
+    # The name exists after all
+    cache_store.pop(_key(name, 0), None)
+
+
+def cache_negative(qr, name, type, now):
+    """RFC 2308 caching of NXDOMAIN for the name or NODATA for the type."""
+    soa = [a for a in qr.get("Authority") or [] if a["type"] == 6]
+    if not soa:
+        return  # Cannot know how long the answer is valid for
+    soa = soa[0]
+    try:
+        ttl = min(max_negative_ttl, soa["TTL"], int(soa["data"].split()[-1]))
+    except ValueError:
         return
+    expire = now + ttl
+    key = _key(name, 0 if qr["Status"] == 3 else type)
+    entry = {
+        "Answer": [],
+        "Negative": expire,
+        "SOA": [soa["name"], expire, soa["data"]],
+        "Expiry": expire,
+    }
+    store(key, entry, cache_store.get(key, {}), now)
+
+
+def _chain_end(name, type, rrsets):
+    """Last name of the CNAME chain from name, or None if it has records of
+    the type (or the chain is too long to follow)."""
+    name = str(name).lower()
+    for _ in range(max_chain):
+        if (name, type) in rrsets:
+            return None
+        cname = rrsets.get((name, 5))
+        if not cname:
+            return name
+        name = cname[0][1].lower()
+    return None
+
+
+def cache(answers):
+    """Store each RRset of answers, including CNAME chain targets, and a
+    negative answer for the last name of a chain if it has no records."""
     now = int(datetime.now().timestamp())
-    old = cache_store.get(key, dict(Answer=[]))
-    merger = {(t, data): expire for t, expire, data in old["Answer"]}
-    for a in qr["Answer"]:
-        n, t, expire, data = a["name"], a["type"], now + a["TTL"], a["data"]
-        if n == name and merger.get((t, data), 0) < expire:
-            merger[(t, data)] = expire
-    answer = [[t, expire, data] for (t, data), expire in merger.items() if expire > now]
-    if answer:
-        expiry = min(now + 86400, max(merger.values()))
-        cache_store[key] = {"Answer": answer, "Expiry": expiry}
-    elif key in cache_store:
-        del cache_store[key]
-    # Remove from cache all expired keys
-    for k in list(cache_store.keys()):
-        if cache_store[k]["Expiry"] < now:
-            del cache_store[k]
-
-
-async def resolve_answer(name, type, recurse_cnames=True):
-    global cache_store
-    key = f"dns:{name}"
+    for qr in answers:
+        _cache(qr, now)
+    evict(now)
+
+
+def _cache(qr, now):
+    question = qr["Question"][0]
+    rrsets = {}
+    for a in qr.get("Answer") or []:
+        rrset = rrsets.setdefault((a["name"].lower(), a["type"]), [])
+        rrset.append([now + min(a["TTL"], max_ttl), a["data"]])
+    for (name, type), records in rrsets.items():
+        cache_records(name, type, records, now)
+    if qr.get("Status") in (0, 3) and question["type"] not in (5, 255):
+        name = _chain_end(question["name"], question["type"], rrsets)
+        if name is not None:
+            cache_negative(qr, name, question["type"], now)
+
+
+def _ttl(expire, now):
+    return expire - now if expire > now else stale_ttl
+
+
+def _valid(entry, valid):
+    return entry.get("Negative", 0) > valid or any(
+        expire > valid for expire, _ in entry["Answer"]
+    )
+
+
+def _get(key, valid):
+    """Entry with any records or negative answer valid, or None."""
+    entry = cache_store.get(key)
+    if not (entry and _valid(entry, valid)):
+        if not (shared and load_shared(key)):
+            return None
+        entry = cache_store[key]
+        if not _valid(entry, valid):
+            return None
+    cache_store.move_to_end(key)
+    return entry
+
+
+def lookup(name, type, stale=False):
+    """Answer from cache, following CNAME chains to their end. Returns status,
+    answer and authority, and the entry of the name asked."""
     now = int(datetime.now().timestamp())
-    cached = cache_store.get(key)
-    if not cached:
-        raise WontResolve(f"[RamCache] {name} not found")
-    try:
-        answer = [
-            dict(name=name, type=t, TTL=expire - now, data=data)
-            for t, expire, data in cached["Answer"]
-            if expire > now and (type == 255 or type == t or t == 5)
+    valid = now - stale_window if stale else now
+    name, answer, first = str(name), [], None
+    for _ in range(max_chain):
+        entry, nxdomain = _get(_key(name, type), valid), False
+        if entry is None and type != 5:
+            cname = _get(_key(name, 5), valid)
+            if cname and cname["Answer"]:
+                expire, target = max(r for r in cname["Answer"] if r[0] > valid)
+                answer.append(
+                    dict(name=name, type=5, TTL=_ttl(expire, now), data=target)
+                )
+                first = first or cname
+                name = target
+                continue
+            entry, nxdomain = _get(_key(name, 0), valid), True
+        if entry is None:
+            break
+        first = first or entry
+        records = [
+            dict(name=name, type=type, TTL=_ttl(expire, now), data=data)
+            for expire, data in entry["Answer"]
+            if expire > valid
         ]
-        if recurse_cnames:
-            for cname in {a["data"] for a in answer if a["type"] == 5}:
-                answer += await resolve_answer(cname, type, recurse_cnames=False)
-    except Exception as e:
-        raise WontResolve(
-            f"[RamCache] Unexpected error responding from cached={cached!r}",
-            exceptions=[e],
-        )
-    return answer
-
-
-async def resolve(name, type, **kwargs):
-    answer = await resolve_answer(name, type)
-    if not answer:
-        raise WontResolve("No suitable records found in cache")
+        if records:
+            return 0, answer + records, [], first
+        n, expire, data = entry["SOA"]
+        soa = dict(name=n, type=6, TTL=_ttl(expire, now), data=data)
+        return 3 if nxdomain else 0, answer, [soa], first
+    raise WontResolve(f"[RamCache] {name} not found")
+
+
+def count_hit(name, type):
+    """Count a hit on the entry of a name answered from a copy elsewhere (the
+    wire cache of serve53). Returns its hits since it was last updated and the
+    TTL remaining of its records, or None if it is not cached."""
+    name = str(name).lower()
+    for key in _key(name, type), _key(name, 5), _key(name, 0):
+        cached = cache_store.get(key)
+        if cached:
+            now = int(datetime.now().timestamp())
+            cache_store.move_to_end(key)
+            cached["Hits"] = cached.get("Hits", 0) + 1
+            expire = min(
+                (e for e, _ in cached["Answer"] if e > now),
+                default=cached.get("Negative", now),
+            )
+            return cached["Hits"], expire - now
+    return None
+
+
+async def resolve(name, type, stale=False, **kwargs):
+    """Answer from cache. With stale=True, also answers expired within
+    stale_window are used, for when upstream servers fail to respond."""
+    global stats_stale, stats_hits, stats_misses
+    try:
+        status, answer, authority, cached = lookup(name, type, stale)
+    except WontResolve:
+        stats_misses += 1
+        raise
+    except (KeyError, TypeError, ValueError) as e:
+        stats_misses += 1
+        raise WontResolve(f"[RamCache] Unexpected error resolving {name}", [e])
+    stats_hits += 1
+    cached["Hits"] = cached.get("Hits", 0) + 1  # Since the entry was last updated
+    if stale:
+        stats_stale += 1
     return {
-        "Status": 0,
+        "Status": status,
         "TC": False,
         "RD": True,
         "RA": True,
@@ -68,5 +247,82 @@ async def resolve(name, type, **kwargs):
         "CD": False,
         "Question": [dict(name=name, type=type)],
         "Answer": answer,
+        "Authority": authority,
         "NameClient": "RamCache",
+        "Hits": cached["Hits"],
+        **({"Stale": True, "Comment": "stale answer"} if stale else {}),
     }
+
+
+async def load(path):
+    """Load a snapshot written by save(), read in a thread and added in chunks
+    so that queries are being served meanwhile. Entries already cached are kept
+    and expired ones dropped. Expiry times are absolute, so no adjustment is
+    needed. Returns the number of entries loaded."""
+    now = int(datetime.now().timestamp())
+    loaded = 0
+    try:
+        async with await trio.open_file(path, "rb") as f:
+            data = memoryview(await f.read())
+        if data[: len(snapshot_magic)] != snapshot_magic:
+            print(f"[RamCache] {path} is not a cache snapshot, ignored")
+            return 0
+        pos = len(snapshot_magic)
+        while pos < len(data):
+            (length,) = struct.unpack_from("<I", data, pos)
+            pos += 4 + length
+            for key, entry in marshal.loads(data[pos - length : pos]):
+                if entry["Expiry"] > now and key not in cache_store:
+                    cache_store[key] = entry
+                    cache_store.move_to_end(key, last=False)  # Evict first
+                    heapq.heappush(expiry_heap, (entry["Expiry"], key))
+                    loaded += 1
+            await trio.sleep(0)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, EOFError, struct.error) as e:
+        print(f"[RamCache] {path} could not be loaded: {e}")
+    evict(now)
+    return loaded
+
+
+async def save(path):
+    """Atomically replace the snapshot at path with the current cache. Entries
+    are serialized in chunks to avoid stalling other tasks, and file I/O is
+    done in a thread."""
+    items = list(cache_store.items())
+    if shared:  # Include names cached only by other workers, scanned in a thread
+        others = await trio.to_thread.run_sync(lambda: list(shared.items()))
+        items += [(k, e) for k, e in others if k not in cache_store]
+    tmp = f"{path}.{os.getpid()}.tmp"
+    async with await trio.open_file(tmp, "wb") as f:
+        await f.write(snapshot_magic)
+        for i in range(0, len(items), snapshot_chunk):
+            chunk = marshal.dumps(items[i : i + snapshot_chunk])
+            await f.write(struct.pack("<I", len(chunk)) + chunk)
+        await f.flush()
+        await trio.to_thread.run_sync(os.fsync, f.fileno())
+    await trio.to_thread.run_sync(os.replace, tmp, path)
+
+
+async def snapshot_task(path):
+    while True:
+        await trio.sleep(snapshot_interval)
+        try:
+            await save(path)
+        except OSError as e:
+            print(f"[RamCache] saving {path} failed: {e}")
+
+
+def collect_metrics():
+    return [
+        ("named1_cache_entries", {}, len(cache_store)),
+        ("named1_cache_hits_total", {}, stats_hits),
+        ("named1_cache_misses_total", {}, stats_misses),
+        ("named1_cache_stale_total", {}, stats_stale),
+        ("named1_cache_expired_total", {}, stats_expired),
+        ("named1_cache_evictions_total", {}, stats_evictions),
+    ]
+
+
+metrics.collectors.append(collect_metrics)
@@ -0,0 +1,123 @@
+"""Response rate limiting per client network, in the spirit of BIND RRL.
+
+Each /24 (IPv4) or /56 (IPv6) network has a token bucket, stored as the time
+when it is full again (GCRA), so that a bucket is one float and buckets of
+networks gone quiet expire by themselves. Over the limit, every slip-th UDP
+response is sent empty and truncated, so that real clients retry over TCP
+(which cannot be spoofed), and the others are dropped. Queries that cannot be
+answered from cache have a separate limit, so that one client cannot use up
+the upstream streams while cached answers keep flowing. Both are off unless
+set, since a LAN or clients behind a NAT share a network."""
+
+import socket
+import time
+from itertools import islice
+
+from named1 import metrics
+
+responses_per_second = 0.0  # Per network over UDP, 0 to disable
+response_burst = 400
+misses_per_second = 0.0  # Per network, queries sent upstream, 0 to disable
+miss_burst = 100
+slip = 2  # Every slip-th limited response is truncated, others dropped (0 = all)
+ipv4_prefix = 24
+ipv6_prefix = 56
+exempt_loopback = True  # Local clients cannot be spoofed from the network
+table_size = 100000  # Networks tracked per table before expiring buckets
+
+responses = {}  # Network -> time when its bucket is full again
+misses = {}
+stats_slipped = stats_dropped = stats_miss_limited = 0
+
+
+def network(addr):
+    """Network of a client address as an integer, or None if exempt."""
+    host = addr[0]
+    if ":" in host:
+        if host.startswith("::ffff:") and "." in host:
+            host = host[7:]  # IPv4-mapped
+        else:
+            packed = socket.inet_pton(socket.AF_INET6, host.split("%")[0])
+            if exempt_loopback and host == "::1":
+                return None
+            return -1 - (int.from_bytes(packed, "big") >> 128 - ipv6_prefix)
+    packed = socket.inet_pton(socket.AF_INET, host)
+    if exempt_loopback and packed[0] == 127:
+        return None
+    return int.from_bytes(packed, "big") >> 32 - ipv4_prefix
+
+
+def _take(table, key, rate, burst, now):
+    """Consume a token from the bucket of key, False if it is empty."""
+    interval = 1 / rate
+    full = table.pop(key, now)  # Reinserted last, keeping the table in LRU order
+    if full < now:
+        full = now
+    if full - now > (burst - 1) * interval:
+        table[key] = full
+        return False
+    if len(table) >= table_size:
+        _expire(table, now)
+    table[key] = full + interval
+    return True
+
+
+def _expire(table, now):
+    for key in [key for key, full in table.items() if full <= now]:
+        del table[key]
+    if len(table) >= table_size:
+        # Flooded from more networks than fit, forget the least recently seen half
+        for key in list(islice(table, len(table) // 2)):
+            del table[key]
+
+
+def response(addr):
+    """None if a UDP response may be sent, otherwise "slip" or "drop"."""
+    global stats_slipped, stats_dropped
+    if not responses_per_second:
+        return None
+    key = network(addr)
+    if key is None or _take(
+        responses, key, responses_per_second, response_burst, time.monotonic()
+    ):
+        return None
+    if slip and (stats_slipped + stats_dropped) % slip == slip - 1:
+        stats_slipped += 1
+        return "slip"
+    stats_dropped += 1
+    return "drop"
+
+
+def miss(addr):
+    """Whether a query from addr may be sent upstream, consuming a token that
+    should be refunded if it was answered from cache after all."""
+    global stats_miss_limited
+    if not misses_per_second:
+        return True
+    key = network(addr)
+    if key is None or _take(
+        misses, key, misses_per_second, miss_burst, time.monotonic()
+    ):
+        return True
+    stats_miss_limited += 1
+    return False
+
+
+def refund(addr):
+    """Return the token taken by miss for a query answered from cache."""
+    key = network(addr) if misses_per_second else None
+    if key in misses:
+        misses[key] -= 1 / misses_per_second
+
+
+def collect_metrics():
+    return [
+        ("named1_ratelimit_slipped_total", {}, stats_slipped),
+        ("named1_ratelimit_dropped_total", {}, stats_dropped),
+        ("named1_ratelimit_miss_limited_total", {}, stats_miss_limited),
+        ("named1_ratelimit_networks", dict(table="responses"), len(responses)),
+        ("named1_ratelimit_networks", dict(table="misses"), len(misses)),
+    ]
+
+
+metrics.collectors.append(collect_metrics)
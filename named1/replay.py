@@ -0,0 +1,183 @@
+"""Replay query traces recorded with --trace against cache policies and
+settings, reporting hit ratio, upstream queries and memory for each, so that
+cache size, TTL caps and prefetching can be chosen from real traffic.
+
+A policy is a class in policies, created with the settings of a run, whose
+get(key, now) returns the expiry time of a cached answer or None, and
+put(key, expire, now) stores one. LRU is the policy of RamCache. Queries
+answered from the wire cache of serve53 are replayed like any other, so hit
+ratios are of all queries."""
+
+import heapq
+import itertools
+import tracemalloc
+from collections import OrderedDict
+
+from named1 import prefetch, ramcache, trace
+
+policies = {}
+
+
+def policy(cls):
+    policies[cls.__name__.lower()] = cls
+    return cls
+
+
+@policy
+class LRU:
+    """Least recently used evicted beyond size, others kept until stale_window
+    after they expire."""
+
+    def __init__(self, settings):
+        self.size = settings["size"]
+        self.entries = OrderedDict()  # key -> expire
+        self.expiry_heap = []
+
+    def get(self, key, now):
+        expire = self.entries.get(key)
+        if expire is None or expire <= now:
+            return None
+        self.entries.move_to_end(key)
+        return expire
+
+    def put(self, key, expire, now):
+        self.entries[key] = expire
+        self.entries.move_to_end(key)
+        heapq.heappush(self.expiry_heap, (expire + ramcache.stale_window, key))
+        while self.expiry_heap and self.expiry_heap[0][0] < now:
+            gone, key = heapq.heappop(self.expiry_heap)
+            if self.entries.get(key, gone) + ramcache.stale_window == gone:
+                self.entries.pop(key, None)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+@policy
+class FIFO(LRU):
+    """Oldest stored evicted beyond size, regardless of hits."""
+
+    def get(self, key, now):
+        expire = self.entries.get(key)
+        return expire if expire is not None and expire > now else None
+
+
+def simulate(records, settings):
+    """Statistics of answering the queries of records with the settings."""
+    cache = policies[settings["policy"]](settings)
+    min_hits, lead_time = settings["min_hits"], settings["lead_time"]
+    ttls = {}  # key -> TTL last answered from upstream
+    hits = {}  # key -> cache hits since stored
+    schedule, scheduled = [], set()  # Prefetches due
+    queries = cached = upstream = prefetches = peak = 0
+
+    def store(key, ttl, negative, now):
+        cap = settings["negative_ttl"] if negative else settings["max_ttl"]
+        cache.put(key, now + min(ttl, cap), now)
+        hits[key] = 0
+
+    for t, _, type, rcode, answers, ttl, source, name in records:
+        if source == "Policy":
+            continue
+        while schedule and schedule[0][0] <= t:
+            due, key = heapq.heappop(schedule)
+            scheduled.discard(key)
+            upstream += 1
+            prefetches += 1
+            store(key, *ttls[key], due)
+        key = name, type
+        queries += 1
+        expire = cache.get(key, t)
+        if expire is not None:
+            cached += 1
+            hits[key] += 1
+            if min_hits and hits[key] >= min_hits and key not in scheduled:
+                scheduled.add(key)
+                heapq.heappush(schedule, (expire - lead_time, key))
+            continue
+        upstream += 1
+        if ttl < 0 or rcode not in (0, 3):
+            continue  # Failures are not cached
+        # Cached answers have the TTL remaining, use the original if known
+        if source not in ("RamCache", "WireCache") or key not in ttls:
+            ttls[key] = ttl, rcode == 3 or not answers
+        store(key, *ttls[key], t)
+        peak = max(peak, len(cache))
+    return dict(
+        queries=queries,
+        hit_ratio=round(cached / queries, 4) if queries else 0.0,
+        upstream=upstream,
+        prefetches=prefetches,
+        peak_entries=peak,
+    )
+
+
+def entry_bytes(keys):
+    """Average memory of a RamCache entry of an A record, for the names."""
+    sample = list(itertools.islice(keys, 10000))
+    tracemalloc.start()
+    store = OrderedDict(
+        (ramcache._key(n, t), {"Answer": [[i + 10**9, "192.0.2.1"]], "Expiry": i})
+        for i, (n, t) in enumerate(sample)
+    )
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del store
+    return size / max(1, len(sample))
+
+
+def main():
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(
+        description="Replay query traces against cache policies and settings; "
+        "several values may be given for each setting to try all combinations"
+    )
+    parser.add_argument("traces", nargs="+", help="Files written with --trace")
+    parser.add_argument("--policy", nargs="+", default=["lru"], choices=policies)
+    parser.add_argument("--size", nargs="+", type=int, default=[ramcache.max_entries])
+    parser.add_argument("--max-ttl", nargs="+", type=int, default=[ramcache.max_ttl])
+    parser.add_argument(
+        "--negative-ttl", nargs="+", type=int, default=[ramcache.max_negative_ttl]
+    )
+    parser.add_argument(
+        "--min-hits",
+        nargs="+",
+        type=int,
+        default=[prefetch.min_hits],
+        help="Hits to prefetch a name, 0 to disable prefetching",
+    )
+    parser.add_argument(
+        "--lead-time", nargs="+", type=float, default=[prefetch.lead_time]
+    )
+    parser.add_argument("--json", action="store_true", help="Output JSON lines")
+    args = parser.parse_args()
+    records = list(heapq.merge(*map(trace.read, args.traces)))
+    per_entry = entry_bytes(dict.fromkeys((r[7], r[2]) for r in records))
+    names = "policy", "size", "max_ttl", "negative_ttl", "min_hits", "lead_time"
+    if not args.json:
+        print(f"{len(records)} queries, about {per_entry:.0f} bytes per cache entry")
+        print(
+            "".join(f"{n:>13}" for n in names)
+            + f"{'hit ratio':>10}{'upstream':>10}{'prefetch':>10}"
+            + f"{'entries':>10}{'MB':>8}"
+        )
+    for values in itertools.product(*(getattr(args, n) for n in names)):
+        settings = dict(zip(names, values))
+        res = simulate(records, settings)
+        res["memory_mb"] = round(res["peak_entries"] * per_entry / 1e6, 1)
+        if args.json:
+            print(json.dumps({**settings, **res}))
+            continue
+        print(
+            "".join(f"{v:>13}" for v in values)
+            + f"{res['hit_ratio']:10.1%}{res['upstream']:10d}{res['prefetches']:10d}"
+            + f"{res['peak_entries']:10d}{res['memory_mb']:8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
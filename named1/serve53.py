@@ -1,22 +1,205 @@
+import functools
+import socket as stdlib_socket
+import struct
+from collections import OrderedDict
+from contextlib import suppress
+
 import trio
 from dns import edns, flags, message, name, rcode, rrset
-from trio.socket import AF_INET, AF_INET6, SO_REUSEPORT, SOCK_DGRAM, SOL_SOCKET, socket
+from trio.socket import (
+    AF_INET,
+    AF_INET6,
+    SO_REUSEPORT,
+    SOCK_DGRAM,
+    SOCK_STREAM,
+    SOL_SOCKET,
+    from_stdlib_socket,
+    socket,
+)
+
+from named1 import codec, metrics, prefetch, ratelimit, trace
+from named1.dnserror import WontResolve
 
 origin = name.Name([b""])
 
+# Rendered responses by query shape, reused without invoking resolve again
+# key -> (created, expires, wire, [(offset, TTL), ...], (name, type, source))
+wire_cache = OrderedDict()
+wire_cache_size = 10000
+wire_max_age = 5  # Seconds, so that changes in the resolver's cache propagate
+stats_wire_hits = stats_wire_misses = 0
 
-async def _process(sock, resolve, data, addr):
+tcp_idle_timeout = 10  # Seconds without queries before closing a connection
+tcp_max_queries = 100  # Queries answered per connection before closing it
+stats_truncated = stats_tcp_connections = stats_tcp_queries = 0
+
+udp_workers = 256  # Queries being resolved concurrently, per socket
+udp_queue = 1024  # Queries waiting for a worker, beyond which SERVFAIL is sent
+udp_batch = 64  # Datagrams received per wakeup of the event loop
+stats_udp_queue = {}  # Listening address -> number of queries waiting
+stats_udp_dropped = stats_servfail = 0
+query_latency = metrics.histogram("named1_query_seconds")
+
+
+def _skip_name(data, pos):
+    while True:
+        length = data[pos]
+        if length >= 0xC0:  # Compression pointer ends the name
+            return pos + 2
+        pos += 1 + length
+        if not length:
+            return pos
+
+
+def _query_key(data):
+    """Cache key of a plain query, or None if the query is not cacheable:
+    (question in lower case, RD/CD flags, EDNS payload size and DO bit)"""
     try:
-        msg = message.from_wire(data)
-    except Exception:
-        print(f"[Serve53] invalid message from {addr}")
-        return
+        _, qflags, qdcount, ancount, nscount, arcount = struct.unpack_from(">6H", data)
+        if qflags & 0xF800 or qdcount != 1 or ancount or nscount or arcount > 1:
+            return None  # Not a standard query
+        end = _skip_name(data, 12) + 4
+        # Only the name is case insensitive, not the type and class that follow
+        question = bytes(data[12 : end - 4]).lower() + bytes(data[end - 4 : end])
+        edns_shape = None
+        if arcount:
+            if data[end] != 0 or data[end + 1 : end + 3] != b"\0\x29":
+                return None
+            payload, ttl, rdlen = struct.unpack_from(">HIH", data, end + 3)
+            if rdlen or end + 11 != len(data):
+                return None  # Options such as NSID need a fresh response
+            edns_shape = payload, ttl & 0xFFFF8000
+        elif end != len(data):
+            return None
+        return question, qflags & 0x0110, edns_shape
+    except (IndexError, struct.error):
+        return None
+
+
+def _records(wire):
+    """Return the end of question section and (start, type, TTL offset, TTL,
+    end) of each resource record in a message."""
+    qdcount, ancount, nscount, arcount = struct.unpack_from(">4H", wire, 4)
+    pos = 12
+    for _ in range(qdcount):
+        pos = _skip_name(wire, pos) + 4
+    qend, records = pos, []
+    for _ in range(ancount + nscount + arcount):
+        start, pos = pos, _skip_name(wire, pos)
+        rtype, _, ttl, rdlen = struct.unpack_from(">HHIH", wire, pos)
+        records.append((start, rtype, pos + 4, ttl, pos + 10 + rdlen))
+        pos += 10 + rdlen
+    return qend, records
+
+
+def _ttl_offsets(wire):
+    """Locate the TTL fields of all records (except OPT) in a response."""
+    return [(offset, ttl) for _, t, offset, ttl, _ in _records(wire)[1] if t != 41]
+
+
+def _udp_limit(data):
+    """Maximum UDP response size that the client accepts."""
+    try:
+        for _, rtype, offset, _, _ in _records(data)[1]:
+            if rtype == 41:  # OPT record class is the payload size
+                return max(512, struct.unpack_from(">H", data, offset - 2)[0])
+    except (IndexError, struct.error):
+        pass
+    return 512
+
+
+def _empty(data, rc, tc=False):
+    """Response to a query with only the question section."""
+    qend = _records(data)[0]
+    header = bytearray(data[:12])
+    header[2] = 0x80 | header[2] & 0x79 | (0x02 if tc else 0)  # QR, opcode, RD
+    header[3] = rc
+    struct.pack_into(">3H", header, 6, 0, 0, 0)
+    return bytes(header) + bytes(data[12:qend])
+
+
+def _servfail(data):
+    """Minimal SERVFAIL response to a query, for shedding load."""
+    return _empty(data, rcode.SERVFAIL)
+
+
+def _truncate(wire, limit):
+    """Strip all records but OPT from a response too large, setting TC."""
+    global stats_truncated
+    if len(wire) <= limit:
+        return wire
+    stats_truncated += 1
+    qend, records = _records(wire)
+    opt = [wire[start:end] for start, t, _, _, end in records if t == 41]
+    header = bytearray(wire[:12])
+    header[2] |= 0x02  # TC
+    struct.pack_into(">3H", header, 6, 0, 0, len(opt))
+    return bytes(header) + bytes(wire[12:qend]) + b"".join(opt)
+
+
+def _cached_response(data, key):
+    global stats_wire_hits
+    cached = wire_cache.get(key)
+    now = trio.current_time()
+    if not cached or cached[1] <= now:
+        if cached:
+            del wire_cache[key]
+        return None
+    stats_wire_hits += 1
+    wire_cache.move_to_end(key)
+    created, _, wire, offsets, (qname, qtype, source) = cached
+    wire = bytearray(wire)
+    wire[:2] = data[:2]  # Query ID
+    qend = 12 + len(key[0])
+    wire[12:qend] = data[12:qend]  # Question name with the client's letter case
+    age = int(now - created)
+    if age:
+        for offset, ttl in offsets:
+            struct.pack_into(">I", wire, offset, max(0, ttl - age))
+    if source != "Policy":
+        prefetch.wire_hit(qname, qtype)  # RamCache does not see this hit
+    if trace.path:
+        ttl = max(0, min(t for _, t in offsets) - age)
+        trace.record_cached(qname, qtype, wire, ttl, source)
+    return wire
+
+
+def _cache_response(key, wire, query):
     try:
-        do = "1" if msg.flags & flags.DO else "0"
-        rr = msg.question[0]
-        res = await resolve(name=rr.name, type=rr.rdtype, do=do)
-        want_nsid = edns.NSID in (o.otype for o in msg.options)
-        msg = message.make_response(msg)
+        offsets = _ttl_offsets(wire)
+    except (IndexError, struct.error):
+        return
+    rc = wire[3] & 0xF
+    if not offsets or rc not in (rcode.NOERROR, rcode.NXDOMAIN) or wire[2] & 0x02:
+        return  # Nothing to expire by, a failure, or truncated
+    ttl = min(wire_max_age, *(ttl for _, ttl in offsets))
+    if ttl > 0:
+        now = trio.current_time()
+        wire_cache[key] = now, now + ttl, bytes(wire), offsets, query
+        wire_cache.move_to_end(key)
+        while len(wire_cache) > wire_cache_size:
+            wire_cache.popitem(last=False)
+
+
+async def _process(sock, resolve, data, addr):
+    wire = await _answer(resolve, data, addr)
+    if wire:
+        await sock.sendto(_truncate(wire, _udp_limit(data)), addr)
+
+
+def _nsid(res):
+    comment = res.get("Comment")
+    return f"named1/{res['NameClient']}{': ' + comment if comment else ''}".encode()
+
+
+def _message_response(query, res):
+    """Response built with dnspython, for answers that codec cannot handle."""
+    if "Wire" in res:  # Upstream wire format answer, no need to rebuild it
+        msg = message.from_wire(res["Wire"])
+        msg.id, msg.question = query.id, query.question
+        msg.use_edns(query.edns, query.ednsflags & flags.DO, 8192, query.payload)
+    else:
+        msg = message.make_response(query)
         msg.set_rcode(res.get("Status", rcode.NOERROR))
         msg.question, msg.answer = [], []
         msg.flags |= flags.from_text(
@@ -33,41 +216,212 @@ async def _process(sock, resolve, data, addr):
                 m.append(
                     rrset.from_text(a["name"], a.get("TTL", 0), "IN", a["type"], *data)
                 )
-        if want_nsid:
-            comment = res.get("Comment")
-            nsid = f"named1/{res['NameClient']}{': ' + comment if comment else ''}"
-            msg.options.append(edns.GenericOption(edns.NSID, nsid.encode()))
+    if edns.NSID in (o.otype for o in query.options):
+        options = [*msg.options, edns.GenericOption(edns.NSID, _nsid(res))]
+        msg.use_edns(msg.edns, msg.ednsflags, msg.payload, options=options)
+    return msg.to_wire(origin=origin)
+
+
+async def _answer(resolve, data, addr):
+    """Response in wire format to a query, or None if it cannot be parsed."""
+    global stats_wire_misses, stats_servfail
+    key = _query_key(data)
+    if key:
+        wire = _cached_response(data, key)
+        if wire:
+            return wire
+        stats_wire_misses += 1
+    # Common queries are handled by codec, others by dnspython
+    query, msg = codec.parse_query(data), None
+    if query:
+        qname, qtype, opt = query[2], query[3], query[5]
+        do, want_nsid = opt and opt[1], opt and opt[2]
+    else:
+        try:
+            msg = message.from_wire(data)
+            rr = msg.question[0]
+        except Exception:
+            print(f"[Serve53] invalid message from {addr}")
+            return None
+        qname, qtype, do = str(rr.name), rr.rdtype, msg.ednsflags & flags.DO
+    start_time = trio.current_time()
+    upstream = ratelimit.miss(addr)
+    source = "WireCache"
+    try:
+        res = await resolve(
+            name=qname, type=qtype, do="1" if do else "0", upstream=upstream
+        )
+        if res["NameClient"] == "Policy":
+            source = "Policy"  # Local answers are not cache hits
+        if upstream and res["NameClient"] == "RamCache":
+            ratelimit.refund(addr)
+        wire = query and codec.response(
+            data, query, res, _nsid(res) if want_nsid else None
+        )
+        if not wire:
+            wire = _message_response(msg or message.from_wire(data), res)
+    except WontResolve:  # Over the miss limit and not in cache
+        wire = _empty(data, rcode.REFUSED)
     except Exception as e:  # Don't die on errors/timeouts but report back a failure
         if not isinstance(e, trio.TooSlowError):
-            print(f"{e!r}\n{msg}")
-        msg.flags = flags.QR
-        msg.set_rcode(rcode.SERVFAIL)
+            print(f"[Serve53] {qname} {e!r}")
+        stats_servfail += 1
+        wire = _servfail(data)
+    query_latency.observe(trio.current_time() - start_time)
+    if key and upstream:  # Not answers limited to the cache, maybe stale
+        _cache_response(key, wire, (qname, qtype, source))
+    return wire
+
+
+async def _bind(sock, addr, proto):
     try:
-        await sock.sendto(msg.to_wire(origin=origin), addr)
-    except Exception as e:
-        raise Exception(
-            f"Malformed output with answer:\n{res}\n\nand msg:\n{msg}"
-        ) from e
+        sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        await sock.bind(addr)
+        print(f"[Serve53] listening on {addr} {proto}")
+        return True
+    except OSError as e:
+        if e.errno == 13:
+            reason = "permission denied (run with sudo?)"
+        elif e.errno in (48, 49, 98):
+            reason = "already in use (is another DNS server running?)"
+        else:
+            reason = str(e)
+        print(f"[Serve53] {addr} {proto} {reason}")
+        return False
 
 
-async def serve53(addr, resolve, task_status=trio.TASK_STATUS_IGNORED):
-    with socket(AF_INET6 if ":" in addr[0] else AF_INET, SOCK_DGRAM) as sock:
+async def _udp_worker(sock, resolve, queries):
+    async for data, addr in queries:
+        await _process(sock, resolve, data, addr)
+
+
+def _ingest(raw, queue):
+    """Answer ready datagrams from cache, queueing the others for workers.
+    Returns False once no more datagrams are waiting."""
+    global stats_udp_dropped
+    for _ in range(udp_batch):
         try:
-            sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
-            await sock.bind(addr)
-            print(f"[Serve53] listening on {addr}")
-        except OSError as e:
-            if e.errno == 13:
-                reason = "permission denied (run with sudo?)"
-            elif e.errno in (48, 49):
-                reason = "already in use (is another DNS server running?)"
-            else:
-                reason = str(e)
-            print(f"[Serve53] {addr} {reason}")
-            return
+            data, addr = raw.recvfrom(8192)
+        except BlockingIOError:
+            return False
+        try:
+            limited = ratelimit.response(addr)
+            if limited:
+                if limited == "slip":
+                    raw.sendto(_empty(data, rcode.NOERROR, tc=True), addr)
+                continue
+            key = _query_key(data)
+            wire = key and _cached_response(data, key)
+            if wire:
+                raw.sendto(_truncate(wire, _udp_limit(data)), addr)
+                continue
+            try:
+                queue.send_nowait((data, addr))
+            except trio.WouldBlock:
+                stats_udp_dropped += 1
+                raw.sendto(_servfail(data), addr)
+        except (OSError, IndexError, struct.error):
+            pass  # Malformed query or socket buffer full, just drop it
+    return True
+
+
+async def _serve_udp(addr, resolve, task_status=trio.TASK_STATUS_IGNORED):
+    raw = stdlib_socket.socket(AF_INET6 if ":" in addr[0] else AF_INET, SOCK_DGRAM)
+    with from_stdlib_socket(raw) as sock:  # Also sets raw non-blocking
+        try:
+            if not await _bind(sock, addr, "UDP"):
+                return
         finally:
             task_status.started()
-        async with trio.open_nursery() as resolvers:
+        queue, queued = trio.open_memory_channel(udp_queue)
+        async with trio.open_nursery() as nursery:
+            for _ in range(udp_workers):
+                nursery.start_soon(_udp_worker, sock, resolve, queued.clone())
             while True:
-                data, addr = await sock.recvfrom(8192)
-                resolvers.start_soon(_process, sock, resolve, data, addr)
+                await trio.lowlevel.wait_readable(raw)
+                while _ingest(raw, queue):
+                    await trio.sleep(0)  # Let workers run between batches
+                stats_udp_queue[addr] = queue.statistics().current_buffer_used
+
+
+async def _tcp_connection(stream, resolve):
+    """RFC 7766 pipelined queries, answered in the order they complete."""
+    global stats_tcp_connections, stats_tcp_queries
+    stats_tcp_connections += 1
+    send_lock = trio.Lock()
+    try:
+        addr = stream.socket.getpeername()
+    except OSError:  # Reset before we got to it
+        await stream.aclose()
+        return
+
+    async def query(data):
+        wire = await _answer(resolve, data, addr)
+        if wire:
+            async with send_lock:
+                with suppress(trio.BrokenResourceError, trio.ClosedResourceError):
+                    await stream.send_all(struct.pack(">H", len(wire)) + wire)
+
+    async with stream, trio.open_nursery() as nursery:
+        buf = b""
+        for _ in range(tcp_max_queries):
+            while len(buf) < 2 or len(buf) < 2 + struct.unpack_from(">H", buf)[0]:
+                data = None
+                with trio.move_on_after(tcp_idle_timeout):
+                    with suppress(trio.BrokenResourceError):
+                        data = await stream.receive_some(65536)
+                if not data:
+                    return  # Idle, closed or broken; finish pending queries
+                buf += data
+            length = struct.unpack_from(">H", buf)[0]
+            data, buf = buf[2 : 2 + length], buf[2 + length :]
+            stats_tcp_queries += 1
+            nursery.start_soon(query, data)
+
+
+async def _tcp_handler(stream, resolve):
+    """Errors of a single connection must not reach the listener and end it."""
+    try:
+        await _tcp_connection(stream, resolve)
+    except Exception as e:
+        print(f"[Serve53] TCP connection failed: {e!r}")
+
+
+async def _serve_tcp(addr, resolve, task_status=trio.TASK_STATUS_IGNORED):
+    sock = socket(AF_INET6 if ":" in addr[0] else AF_INET, SOCK_STREAM)
+    try:
+        if not await _bind(sock, addr, "TCP"):
+            sock.close()
+            return
+        sock.listen()
+    finally:
+        task_status.started()
+    await trio.serve_listeners(
+        functools.partial(_tcp_handler, resolve=resolve),
+        [trio.SocketListener(sock)],
+    )
+
+
+async def serve53(addr, resolve, task_status=trio.TASK_STATUS_IGNORED):
+    async with trio.open_nursery() as nursery:
+        await nursery.start(_serve_udp, addr, resolve)
+        await nursery.start(_serve_tcp, addr, resolve)
+        task_status.started()
+
+
+def collect_metrics():
+    ret = [
+        ("named1_wire_cache_hits_total", {}, stats_wire_hits),
+        ("named1_wire_cache_misses_total", {}, stats_wire_misses),
+        ("named1_servfail_total", {}, stats_servfail),
+        ("named1_truncated_total", {}, stats_truncated),
+        ("named1_tcp_connections_total", {}, stats_tcp_connections),
+        ("named1_tcp_queries_total", {}, stats_tcp_queries),
+        ("named1_udp_dropped_total", {}, stats_udp_dropped),
+    ]
+    for (host, port), depth in stats_udp_queue.items():
+        ret.append(("named1_udp_queue", dict(listen=f"{host}:{port}"), depth))
+    return ret
+
+
+metrics.collectors.append(collect_metrics)
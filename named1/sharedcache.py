@@ -0,0 +1,71 @@
+import hashlib
+import marshal
+import mmap
+import multiprocessing
+import struct
+from datetime import datetime
+
+slot_header = struct.Struct("<QIH")  # Key hash, expiry, payload length
+
+
+class SharedCache:
+    """Cache entries shared by forked worker processes. Stored in anonymous
+    shared memory as a hash table of fixed size slots, where an entry simply
+    replaces whatever was in its slot. Entries too large for a slot are not
+    shared."""
+
+    def __init__(self, slots=65536, slot_size=1024, locks=64):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.mem = mmap.mmap(-1, slots * slot_size)  # MAP_SHARED across fork
+        ctx = multiprocessing.get_context("fork")
+        self.locks = [ctx.Lock() for _ in range(locks)]
+        self.stats_hits = self.stats_misses = self.stats_stores = 0
+
+    def _slot(self, key):
+        h = int.from_bytes(
+            hashlib.blake2b(key.encode(), digest_size=8).digest(), "little"
+        )
+        slot = h % self.slots
+        return h, slot * self.slot_size, self.locks[slot % len(self.locks)]
+
+    def get(self, key):
+        h, offset, lock = self._slot(key)
+        now = int(datetime.now().timestamp())
+        with lock:
+            stored, expiry, length = slot_header.unpack_from(self.mem, offset)
+            if stored == h and expiry > now:
+                start = offset + slot_header.size
+                payload = self.mem[start : start + length]
+            else:
+                payload = None
+        if payload:
+            stored_key, entry = marshal.loads(payload)
+            if stored_key == key:
+                self.stats_hits += 1
+                return entry
+        self.stats_misses += 1
+        return None
+
+    def put(self, key, entry):
+        payload = marshal.dumps((key, entry))
+        if slot_header.size + len(payload) > self.slot_size:
+            return
+        h, offset, lock = self._slot(key)
+        with lock:
+            slot_header.pack_into(self.mem, offset, h, entry["Expiry"], len(payload))
+            start = offset + slot_header.size
+            self.mem[start : start + len(payload)] = payload
+        self.stats_stores += 1
+
+    def items(self):
+        """All unexpired (key, entry) pairs."""
+        now = int(datetime.now().timestamp())
+        for slot in range(self.slots):
+            offset = slot * self.slot_size
+            with self.locks[slot % len(self.locks)]:
+                _, expiry, length = slot_header.unpack_from(self.mem, offset)
+                start = offset + slot_header.size
+                payload = self.mem[start : start + length] if expiry > now else None
+            if payload:
+                yield marshal.loads(payload)
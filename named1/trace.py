@@ -0,0 +1,141 @@
+"""Binary log of queries answered, for replaying offline with named1.replay.
+
+Records are packed on the hot path into a ring buffer (the oldest are dropped
+if writing falls behind) and appended to the file by trace_task in a thread.
+Each record is the entry header followed by the resolver and name in ASCII.
+Queries answered from the wire cache of serve53 are logged as resolved by
+WireCache, or Policy for local answers."""
+
+import os
+import struct
+import sys
+import time
+from collections import deque
+
+import trio
+
+from named1 import metrics
+
+path = None  # Trace file, appended to
+buffer_size = 65536  # Records waiting to be written
+flush_interval = 1.0  # Seconds between writes
+
+magic = b"named1 trace 1\n"
+# Time, latency (s), type, rcode, answer records, TTL (-1 if unknown), and
+# lengths of the resolver and the name that follow
+entry = struct.Struct("<dfHBBiBB")
+
+buffer = deque(maxlen=buffer_size)
+stats_records = stats_dropped = 0
+
+
+def _ttl(res):
+    return min(
+        (a.get("TTL", 0) for a in res.get("Answer", []) + res.get("Authority", [])),
+        default=-1,
+    )
+
+
+def _append(latency, type, status, answers, ttl, source, name):
+    global stats_records, stats_dropped
+    if len(buffer) == buffer.maxlen:
+        stats_dropped += 1
+    stats_records += 1
+    source, name = source[:255], name[:255]
+    header = entry.pack(
+        time.time(),
+        latency,
+        type,
+        status,
+        min(answers, 255),
+        ttl,
+        len(source),
+        len(name),
+    )
+    buffer.append(header + source + name)
+
+
+def record(dnsquery, res, latency):
+    """Log a query with its answer, or None if it failed."""
+    if res:
+        status, answers, ttl = (
+            res.get("Status", 0),
+            len(res.get("Answer", [])),
+            _ttl(res),
+        )
+        source = res.get("NameClient", "").encode()
+    else:
+        status, answers, ttl, source = 2, 0, -1, b""  # SERVFAIL
+    name = dnsquery["name"].lower().encode()
+    _append(latency, dnsquery["type"], status, answers, ttl, source, name)
+
+
+def record_cached(name, type, wire, ttl, source):
+    """Log a query answered from the wire cache of serve53, given the response
+    in wire format."""
+    answers = struct.unpack_from(">H", wire, 6)[0]
+    name = name.lower().encode()
+    _append(0.0, type, wire[3] & 0xF, answers, ttl, source.encode(), name)
+
+
+def _write(fd, records):
+    os.write(fd, b"".join(records))
+
+
+async def trace_task():
+    global buffer
+    buffer = deque(maxlen=buffer_size)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        if not os.fstat(fd).st_size:
+            os.write(fd, magic)
+        print(f"[Trace] logging queries to {path}")
+        while True:
+            await trio.sleep(flush_interval)
+            records = list(buffer)
+            buffer.clear()
+            if records:
+                await trio.to_thread.run_sync(_write, fd, records)
+    finally:
+        _write(fd, buffer)  # Whatever remains on exit
+        os.close(fd)
+
+
+def read(path):
+    """Yield (time, latency, type, rcode, answers, TTL, resolver, name) records."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(magic):
+        raise ValueError(f"{path} is not a named1 trace")
+    pos = len(magic)
+    while pos + entry.size <= len(data):
+        *fields, slen, nlen = entry.unpack_from(data, pos)
+        pos += entry.size + slen + nlen
+        source = data[pos - slen - nlen : pos - nlen].decode()
+        yield (*fields, source, data[pos - nlen : pos].decode())
+
+
+def collect_metrics():
+    return [
+        ("named1_trace_records_total", {}, stats_records),
+        ("named1_trace_dropped_total", {}, stats_dropped),
+        ("named1_trace_buffered", {}, len(buffer)),
+    ]
+
+
+metrics.collectors.append(collect_metrics)
+
+
+def main():
+    """Print traces given as arguments in text."""
+    for p in sys.argv[1:]:
+        for t, latency, type, rcode, answers, ttl, source, name in read(p):
+            stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+            print(
+                f"{stamp}.{int(t % 1 * 1000):03d} {latency * 1000:7.1f}ms "
+                f"{name} {type} rcode={rcode} answers={answers} ttl={ttl} {source}"
+            )
+
+
+if __name__ == "__main__":
+    main()